@@ -0,0 +1,77 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Hashable, List, Set, Tuple
+
+from config import logger
+from utils import Message, can_merge, merge_messages
+
+
+@dataclass
+class Burst:
+    """Messages of one chat which came shortly after each other, published as one"""
+    messages: List[Message]
+    started: float = field(default_factory=time.monotonic)
+    arrived: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class Debouncer:
+    """
+    Per-chat debounce in front of pubsub. The first text message of a chat waits until no new message came for
+    `window` seconds(but at most `max_wait` seconds), messages which come in the meantime are merged into it.
+    Waiting happens in a task of its own, so the handler which added the message is free right away.
+    """
+
+    def __init__(self, window: float, max_wait: float, publish: Callable[[Message], Awaitable[None]]):
+        self.window = window
+        self.max_wait = max_wait
+        self.publish = publish
+        self.bursts: Dict[Tuple[str, Hashable], Burst] = {}
+        # flush tasks, referenced here so they aren't garbage collected while waiting
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def add(self, message: Message) -> None:
+        """Publishes the message right away if it can't be merged, otherwise adds it to the burst of its chat"""
+        if not self.window or not can_merge(message):
+            await self.publish(message)
+            return
+
+        key = message.session_key
+        burst = self.bursts.get(key)
+        if burst is not None:
+            burst.messages.append(message)
+            burst.arrived.set()
+            logger.debug(f"[Debouncer/add] Merged message {message.id} into a burst of {key}")
+            return
+
+        burst = Burst(messages=[message])
+        self.bursts[key] = burst
+        task = asyncio.create_task(self._flush(key, burst))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, key: Tuple[str, Hashable], burst: Burst) -> None:
+        try:
+            await self._wait_for_quiet(burst)
+        finally:
+            if self.bursts.get(key) is burst:
+                del self.bursts[key]
+        if len(burst.messages) > 1:
+            logger.info(f"[Debouncer/_flush] Merged {len(burst.messages)} messages of {key}")
+        try:
+            await self.publish(merge_messages(burst.messages))
+        except Exception as e:
+            logger.error(f"[Debouncer/_flush] Couldn't publish messages of {key}: {e}")
+
+    async def _wait_for_quiet(self, burst: Burst) -> None:
+        deadline = burst.started + self.max_wait
+        while True:
+            burst.arrived.clear()
+            timeout = min(self.window, deadline - time.monotonic())
+            if timeout <= 0:
+                return
+            try:
+                async with asyncio.timeout(timeout):
+                    await burst.arrived.wait()
+            except TimeoutError:
+                return
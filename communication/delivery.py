@@ -0,0 +1,161 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Hashable, List, Optional, TypeVar
+
+from config import logger
+from utils import metrics
+from .rate_limit import TokenBucket
+
+T = TypeVar('T')
+
+# max length of a single message
+TELEGRAM_LIMIT = 4096
+DISCORD_LIMIT = 2000
+
+CODE_FENCE = '```'
+# preferred places to split a long text, the first one found in the second half of the chunk wins
+BOUNDARIES = ('\n\n', '\n', '. ', '! ', '? ', ' ')
+
+SEND_SECONDS = metrics.histogram(
+    'raise_outbound_send_seconds',
+    'Time of a single send or edit, waiting for rate limits and retries included.',
+    label='interface')
+SEND_RETRIES = metrics.counter('raise_outbound_retries_total', 'Sends which were retried.', label='interface')
+
+
+def split_text(text: str, limit: int) -> List[str]:
+    """
+    Splits text into parts of at most limit characters, at paragraph, line, sentence or word boundaries if possible.
+    Code blocks cut in half are closed at the end of the part and reopened in the next one. limit 0 means no limit.
+    Whitespace between the parts is dropped, platforms refuse empty messages, so blank text has no parts at all.
+    """
+    if not text.strip():
+        return []
+    if not limit or len(text) <= limit:
+        return [text]
+    parts = []
+    reopen = ''
+    while text:
+        text = reopen + text
+        if len(text) <= limit:
+            if text.strip():
+                parts.append(text)
+            break
+        # room for closing a code block
+        window = text[:limit - len(CODE_FENCE) - 1]
+        cut = len(window)
+        for boundary in BOUNDARIES:
+            index = window.rfind(boundary, len(window) // 2)
+            if index != -1:
+                cut = index + len(boundary)
+                break
+        part, text = text[:cut].rstrip(), text[cut:].lstrip(' ')
+        reopen = ''
+        if part.count(CODE_FENCE) % 2:
+            part += '\n' + CODE_FENCE
+            reopen = CODE_FENCE + '\n'
+        if part.strip():
+            parts.append(part)
+    return parts
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the platform asked us to wait, None if the error isn't a rate limit"""
+    value = getattr(error, 'retry_after', None)  # telegram RetryAfter, discord RateLimited
+    if value is None and getattr(error, 'status', None) == 429:
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        value = headers.get('Retry-After', 1.0)
+    if value is None:
+        return None
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+def is_server_error(error: Exception) -> bool:
+    return isinstance(error, TimeoutError) or (getattr(error, 'status', None) or 0) >= 500
+
+
+def is_timeout_error(error: Exception) -> bool:
+    return isinstance(error, TimeoutError)
+
+
+class Outbox:
+    """
+    Outbound sends of one interface. Every send waits for a token of its chat and a global one, so bursts are
+    spread out before the platform starts refusing them. Rate limited sends are retried after the time the
+    platform asks for, errors for which is_transient returns True after 1, 2, 4... seconds.
+    Calls which aren't idempotent(sends) aren't retried after a timeout, the platform might have got them already.
+    """
+
+    def __init__(self,
+                 interface: str,
+                 limit: int,
+                 chat_rate: float,
+                 chat_burst: int,
+                 global_rate: float,
+                 global_burst: int,
+                 max_retries: int = 3,
+                 timeout: Optional[float] = None,
+                 is_transient: Callable[[Exception], bool] = is_server_error,
+                 is_timeout: Callable[[Exception], bool] = is_timeout_error,
+                 max_chats: int = 1024):
+        self.interface = interface
+        self.limit = limit
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.is_transient = is_transient
+        self.is_timeout = is_timeout
+        self.max_chats = max_chats
+        # chat id -> bucket, least recently used chats are forgotten
+        self._chat_buckets: OrderedDict[Hashable, TokenBucket] = OrderedDict()
+
+    def _chat_bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def call(self, chat_id: Hashable, action: Callable[[], Awaitable[T]], idempotent: bool = True) -> T:
+        """
+        Runs a single platform call(send, edit) once there is a token for it, retries it if it makes sense.
+        Sends should pass idempotent=False, a retried send after a timeout may show up twice.
+        """
+        bucket = self._chat_bucket(chat_id)
+        started_at = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                async with asyncio.timeout(self.timeout):
+                    result = await action()
+                SEND_SECONDS.observe(time.perf_counter() - started_at, self.interface)
+                return result
+            except Exception as e:
+                delay = retry_after(e)
+                if (delay is None and not self.is_transient(e)) or attempt == self.max_retries:
+                    raise
+                if delay is None and not idempotent and self.is_timeout(e):
+                    raise
+                delay = delay if delay is not None else 2 ** attempt
+                SEND_RETRIES.inc(1, self.interface)
+                logger.warning(f"[Outbox/call] {self.interface} send to {chat_id} failed: {e!r}, "
+                               f"retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def send_text(self, chat_id: Hashable, text: str, send: Callable[[str], Awaitable[Any]]) -> List[Any]:
+        """
+        Sends text split to the platform limit, parts go out in order. Returns what send returned for each part,
+        nothing is sent for blank text.
+        """
+        return [await self.call(chat_id, lambda part=part: send(part), idempotent=False)
+                for part in split_text(text, self.limit)]
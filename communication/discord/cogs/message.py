@@ -1,76 +1,177 @@
 import asyncio
 import datetime
+from dataclasses import dataclass, field
 
 import discord
-from discord.ext import commands, tasks
-from utils import TextMessage, DiscordMessage
+from discord.ext import commands
+from utils import (TextMessage, DiscordMessage, observe_stage, observe_delivery, PRIORITY_HIGH, PRIORITY_NORMAL,
+                   PRIORITY_LOW)
 from .. import logger
+from ...streaming import StreamedReply, deliver_stream_update
+from ...delivery import Outbox, DISCORD_LIMIT
+from ...debounce import Debouncer
+
+# seconds without replies after which the send worker of a channel stops
+CHANNEL_IDLE_TIMEOUT = 60
+
+
+@dataclass
+class ChannelWorker:
+    """Replies to a single channel, sent in order by its own task"""
+    queue: asyncio.Queue = field(default_factory=asyncio.Queue)
+    task: asyncio.Task | None = None
 
 
 class MessageCog(commands.Cog):
     def __init__(self, bot: commands.Bot) -> None:
-        self.ms_task_started = False
         self.bot = bot
-        self.message = None
-        self.lock = asyncio.Lock()
+        # replies from pubsub, put here from the pubsub thread and sent on the bot's loop
+        self.replies: asyncio.Queue = asyncio.Queue()
+        self.dispatcher: asyncio.Task | None = None
+        # channel id -> replies waiting to be sent there, channels don't wait for each other
+        self.workers: dict[int, ChannelWorker] = {}
+        config = bot.config
+        # paces sends and edits per channel and for the whole bot, splits replies over discord's limit
+        self.outbox = Outbox('discord', DISCORD_LIMIT,
+                             chat_rate=config.channel_rate, chat_burst=config.channel_burst,
+                             global_rate=config.global_rate, global_burst=config.global_burst,
+                             max_retries=config.send_retries, timeout=config.send_timeout)
+        # replies which are being edited while response is streamed, keyed by user message id
+        self.streamed_replies: dict[int, StreamedReply] = {}
+        # merges short messages sent in a row before they go to pubsub
+        self.debouncer = Debouncer(config.coalesce_window, config.coalesce_max_wait, self.publish)
 
     async def cog_load(self) -> None:
         # as in receive response form pubsub, then send this message to discord
         self.bot.pubsub.subscribe(self.bot.subscribe_to, self.save_message)
 
     def cog_unload(self):
-        if not self.ms_task_started:
-            return
-        self.ms.cancel()
+        if self.dispatcher:
+            self.dispatcher.cancel()
+        for worker in self.workers.values():
+            worker.task.cancel()
 
     async def save_message(self, message):
-        async with self.lock:
-            self.message = message
-            logger.info(f"[MessageCog/save_message] Saved {message} to the context")
+        if not isinstance(message, DiscordMessage) or message.session_key[1] is None:
+            # reply to another interface
+            logger.debug(f"[MessageCog/save_message] Skipping message {message.id}, it isn't ours")
+            return
+        try:
+            self.bot.loop.call_soon_threadsafe(self.replies.put_nowait, message)
+        except (AttributeError, RuntimeError):
+            # bot's loop doesn't exist before login and is closed after logout
+            logger.error(f"[MessageCog/save_message] Bot isn't running, reply to {message.id} is lost")
+            return
+        logger.debug(f"[MessageCog/save_message] Queued reply to {message.id}")
 
     @commands.Cog.listener()
     async def on_ready(self):
-        if not self.ms_task_started:
-            logger.info("[MessageCog/on_ready] Starting periodic message loop.")
-            await asyncio.sleep(5)
-            self.ms.start()
-            self.ms_task_started = True
-
-    @tasks.loop(seconds=1)
-    async def ms(self):
-        try:
-            async with self.lock:
-                if not self.message:
+        if self.dispatcher is None:
+            logger.info("[MessageCog/on_ready] Starting reply dispatcher.")
+            self.dispatcher = asyncio.create_task(self.dispatch_replies())
+
+    async def dispatch_replies(self):
+        """Hands replies to the send worker of the channel they came from, starts the worker if needed"""
+        while True:
+            message = await self.replies.get()
+            channel_id = message.session_key[1]
+            worker = self.workers.get(channel_id)
+            if worker is None:
+                worker = ChannelWorker()
+                worker.task = asyncio.create_task(self.channel_worker(channel_id, worker))
+                self.workers[channel_id] = worker
+            worker.queue.put_nowait(message)
+
+    async def channel_worker(self, channel_id: int, worker: ChannelWorker):
+        """Sends replies of one channel in order, stops once the channel is quiet for CHANNEL_IDLE_TIMEOUT"""
+        while True:
+            try:
+                async with asyncio.timeout(CHANNEL_IDLE_TIMEOUT):
+                    message = await worker.queue.get()
+            except TimeoutError:
+                if worker.queue.empty():
+                    del self.workers[channel_id]
                     return
+                continue
+
+            if message.channel is None and not await self.resolve_channel(message, channel_id):
+                continue
+            if message.is_partial or message.id in self.streamed_replies:
+                # registered here, so that the final update of this message knows it has to edit the reply
+                self.streamed_replies.setdefault(message.id, StreamedReply())
+                await self.stream_message(message)
+            else:
+                await self.send_reply(message)
+
+    async def resolve_channel(self, message, channel_id: int) -> bool:
+        """Replayed messages and ones from another process only know the channel id, the channel is looked up"""
+        try:
+            message.channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+        except discord.HTTPException as e:
+            logger.error(f"[MessageCog/resolve_channel] Couldn't find channel {channel_id}, reply to {message.id} "
+                         f"is lost: {e}")
+            return False
+        return True
 
-                id_channel = self.bot.config.bot_chat
-                channel = self.bot.get_channel(id_channel)
+    async def send_reply(self, message):
+        channel = message.channel
+        try:
+            await self.outbox.send_text(channel.id, message.response_message, channel.send)
+            observe_delivery(message)
+        except discord.Forbidden:
+            logger.error("[MessageCog/send_reply] Bot lacks permission to send messages.")
+        except discord.HTTPException as e:
+            logger.error(f"[MessageCog/send_reply] HTTP Exception while sending reply to {message.id}: {e}")
+        except TimeoutError:
+            logger.error(f"[MessageCog/send_reply] Timeout while sending reply to {message.id}.")
 
-                if not channel:
-                    logger.error(f"[MessageCog/ms] Channel with ID {id_channel} not found.")
-                    return
+    async def stream_message(self, message):
+        """Runs on the bot's loop. Sends first part of the response and then edits it as it grows."""
+        channel = message.channel
 
-                logger.debug(f"[MessageCog/ms] Sending periodic message to channel {channel.name} (ID: {id_channel})")
-                async with asyncio.timeout(5):
-                    await channel.send(self.message.response_message)
-                    self.message = None
+        try:
+            await deliver_stream_update(
+                replies=self.streamed_replies,
+                message_id=message.id,
+                text=message.response_message,
+                is_partial=message.is_partial,
+                interval=self.bot.config.stream_edit_interval,
+                send=lambda text: self.outbox.call(channel.id, lambda: channel.send(text), idempotent=False),
+                edit=lambda sent, text: self.outbox.call(channel.id, lambda: sent.edit(content=text)),
+                limit=self.outbox.limit
+            )
+            observe_delivery(message)
         except discord.Forbidden:
-            logger.error("[MessageCog/ms] Bot lacks permission to send messages.")
+            logger.error("[MessageCog/stream_message] Bot lacks permission to send messages.")
         except discord.HTTPException as e:
-            logger.error(f"[MessageCog/ms] HTTP Exception while sending message: {e}")
-        except asyncio.TimeoutError:
-            logger.error("[MessageCog/ms] Timeout while sending message.")
+            logger.error(f"[MessageCog/stream_message] HTTP Exception while sending message: {e}")
+        except TimeoutError:
+            logger.error(f"[MessageCog/stream_message] Timeout while sending reply to {message.id}.")
+
+    def message_priority(self, message: discord.Message) -> int:
+        """Commands skip the queue of text, messages with attachments wait behind it"""
+        prefix = self.bot.command_prefix
+        if isinstance(prefix, str) and message.content.startswith(prefix):
+            return PRIORITY_HIGH
+        if message.attachments:
+            return PRIORITY_LOW
+        return PRIORITY_NORMAL
+
+    def should_answer(self, message: discord.Message) -> bool:
+        """Only the creator is answered, memory and context of the assistant are theirs. Replies go to the same channel"""
+        return message.author.id == self.bot.config.creator_id
 
     @commands.Cog.listener(name="on_message")
     async def handle_message(self, message: discord.Message) -> None:
         if message.author.id == self.bot.user.id:
             return
-        if message.author.id != self.bot.config.creator_id:
+        if not self.should_answer(message):
             return
 
         sender_id = message.author.id
         msg_content = message.content
         datetime_msg = datetime.datetime.now().astimezone()
+        observe_stage('receive', (discord.utils.utcnow() - message.created_at).total_seconds())
 
         logger.debug(
             f"[MessageCog/handle_message] We got message from the user: {sender_id}, content: {msg_content}")
@@ -80,12 +181,16 @@ class MessageCog(commands.Cog):
             from_user=self.bot.creator_username,
             datetime=datetime_msg,
             text_content=TextMessage(msg_content),
+            priority=self.message_priority(message),
             channel=message.channel
         )
         logger.info(f"[MessageCog/handle_message] Sending processed message class to pubsub.")
-        self.bot.pubsub.publish(self.bot.publish_to, msg_cls)
+        await self.debouncer.add(msg_cls)
         await message.channel.typing()
 
+    async def publish(self, message: DiscordMessage) -> None:
+        await self.bot.pubsub.apublish(self.bot.publish_to, message)
+
 
 async def setup(bot: commands.Bot) -> None:
     await bot.add_cog(MessageCog(bot))
@@ -0,0 +1,71 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List
+
+from config import logger
+from .delivery import split_text
+
+
+@dataclass
+class StreamedReply:
+    """Reply message which is edited while the response is still being generated."""
+    # platform message objects we keep editing, long responses take several of them
+    sent: List[Any] = field(default_factory=list)
+    parts: List[str] = field(default_factory=list)
+    text: str = ''
+    last_edit: float = 0.0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def should_edit(self, text: str, interval: float) -> bool:
+        return text != self.text and time.monotonic() - self.last_edit >= interval
+
+
+async def _push(reply: StreamedReply,
+                text: str,
+                send: Callable[[str], Awaitable[Any]],
+                edit: Callable[[Any, str], Awaitable[Any]],
+                limit: int) -> None:
+    # parts which didn't change are left alone, new ones are sent as new messages
+    for index, part in enumerate(split_text(text, limit)):
+        if index >= len(reply.sent):
+            reply.sent.append(await send(part))
+            reply.parts.append(part)
+        elif reply.parts[index] != part:
+            await edit(reply.sent[index], part)
+            reply.parts[index] = part
+    reply.text = text
+    reply.last_edit = time.monotonic()
+
+
+async def deliver_stream_update(replies: Dict[int, StreamedReply],
+                                message_id: int,
+                                text: str,
+                                is_partial: bool,
+                                interval: float,
+                                send: Callable[[str], Awaitable[Any]],
+                                edit: Callable[[Any, str], Awaitable[Any]],
+                                limit: int = 0) -> None:
+    """
+    First part of the response is sent as a new message, later parts edit it.
+    Partial updates are dropped if the previous edit was less than `interval` seconds ago or is still in flight,
+    the final one is always delivered. Responses longer than limit characters continue in further messages.
+    """
+    if is_partial:
+        reply = replies.setdefault(message_id, StreamedReply())
+        if not text or reply.lock.locked() or not reply.should_edit(text, interval):
+            return
+        async with reply.lock:
+            await _push(reply, text, send, edit, limit)
+        return
+
+    reply = replies.pop(message_id, None)
+    if reply is None:
+        for part in split_text(text, limit):
+            await send(part)
+        return
+
+    async with reply.lock:
+        if text != reply.text:
+            await _push(reply, text, send, edit, limit)
+    logger.debug(f"[streaming/deliver_stream_update] Finished streaming reply for message {message_id}")
@@ -1,12 +1,13 @@
-import asyncio
 import datetime
 
-from utils import TextMessage, TelegramMessage
-from telegram import Update, constants
+from utils import TextMessage, TelegramMessage, observe_stage, observe_delivery, PRIORITY_HIGH, PRIORITY_NORMAL
+from telegram import Update, Message
 from telegram.ext import CallbackContext, ContextTypes, ApplicationHandlerStop
-from telegram.constants import ChatAction, ParseMode
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, NetworkError, TimedOut
 
 from . import logger
+from ..streaming import deliver_stream_update
 
 
 async def whitelist_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -33,26 +34,65 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     logger.error(f'[error] USER({update.message.chat.id}) in {update.message.chat.type}: {context.error} from {update}')
 
 
-async def send_message_from_pubsub(message: TelegramMessage):
+async def send_message_from_pubsub(message: TelegramMessage, bot_data: dict):
     # We will get this object form PUBSUB
+    chat_id = message.session_key[1] if isinstance(message, TelegramMessage) else None
+    if chat_id is None:
+        # reply to another interface
+        logger.debug(f"[Telegram/send_message_from_pubsub] Skipping message {message.id}, it isn't ours")
+        return
     try:
         content = message.response_message
-        if not content:
+        if not content and not message.is_partial:
             content = 'Something went wrong. No response was generated'
-        await message.update.message.reply_text(content)
+
+        outbox = bot_data['outbox']
+        if message.update is not None:
+            reply = message.update.message.reply_text
+        else:
+            # replayed after a restart or came from another process, only the chat is known
+            reply = lambda text: bot_data['bot'].send_message(chat_id=chat_id, text=text)
+        await deliver_stream_update(
+            replies=bot_data['streamed_replies'],
+            message_id=message.id,
+            text=content,
+            is_partial=message.is_partial,
+            interval=bot_data['stream_edit_interval'],
+            send=lambda text: outbox.call(chat_id, lambda: reply(text), idempotent=False),
+            edit=lambda sent, text: outbox.call(chat_id, lambda: sent.edit_text(text)),
+            limit=outbox.limit
+        )
+        observe_delivery(message)
     except Exception as e:
         logger.error(f"[Telegram/send_message_from_pubsub] Unexpectedly got an error {e}")
 
 
+def is_transient_error(error: Exception) -> bool:
+    """Timeouts and connection problems are worth another try, bad requests(too long, chat not found) aren't"""
+    return isinstance(error, TimeoutError) or (isinstance(error, NetworkError) and not isinstance(error, BadRequest))
+
+
+def is_timeout_error(error: Exception) -> bool:
+    """Telegram might have delivered a message which timed out, sends aren't retried after these"""
+    return isinstance(error, (TimeoutError, TimedOut))
+
+
+def message_priority(message: Message) -> int:
+    """Commands skip the queue of text. Only text is handled for now, see handle_voice and handle_files"""
+    if message.text and message.text.startswith('/'):
+        return PRIORITY_HIGH
+    return PRIORITY_NORMAL
+
+
 async def handle_message(update: Update, context: CallbackContext):
-    pubsub = context.bot_data['pubsub']
-    topic = context.bot_data['publish_to']
+    debouncer = context.bot_data['debouncer']
     creator_name = context.bot_data['creator_username']
 
     sender = update.message.from_user
     message_from_user = update.message.text
     now = datetime.datetime.now()
     datetime_msg = datetime.datetime.now().astimezone()
+    observe_stage('receive', (datetime_msg - update.message.date).total_seconds())
     # add library or regex to filter out emojis
 
     logger.debug(f"[Telegram/handle_message] We got message from the user: {sender.id}, content: {message_from_user}")
@@ -61,11 +101,12 @@ async def handle_message(update: Update, context: CallbackContext):
         from_user=creator_name,
         datetime=datetime_msg,
         text_content=TextMessage(message_from_user),
+        priority=message_priority(update.message),
         update=update,
         context=context
     )
     logger.info(f"[Telegram/handle_message] Sending processed message class to pubsub.")
-    pubsub.publish(topic, telegram_message)
+    await debouncer.add(telegram_message)
 
     # asyncio.create_task(context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING))
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
@@ -1,4 +1,5 @@
 import asyncio
+import uvicorn
 from telegram import Update
 from telegram.ext import (Application,
                           CommandHandler,
@@ -7,8 +8,12 @@ from telegram.ext import (Application,
                           TypeHandler,
                           )
 
-from .handlers import handle_message, send_message_from_pubsub, error_handler, help_command, start_command, whitelist_user
+from .handlers import (handle_message, send_message_from_pubsub, error_handler, help_command, start_command,
+                       whitelist_user, is_transient_error, is_timeout_error)
 from . import BaseInterface, TelegramSettings, logger
+from .webhook import create_webhook_app
+from ..delivery import Outbox, TELEGRAM_LIMIT
+from ..debounce import Debouncer
 
 
 class TelegramInterface(BaseInterface):
@@ -21,28 +26,54 @@ class TelegramInterface(BaseInterface):
                  creator_username: str
                  ):
         super().__init__(pubsub)
+        if config.mode not in ('polling', 'webhook'):
+            raise ValueError(f"Unknown telegram mode '{config.mode}', expected polling or webhook")
 
         # config variables
         self.CREATOR_ID = config.creator_id
         self.CREATOR_USERNAME = creator_username
         self.publish_to = publish_to
         self.subscribe_to = subscribe_to
-        logger.info(f"[TelegramInterface/__init__] Building an Application")
-        self.app: Application = Application.builder().token(token).build()
+        self.config = config
+        logger.info(f"[TelegramInterface/__init__] Building an Application, {config.mode} mode")
+        builder = Application.builder().token(token)
+        if config.mode == 'webhook':
+            # updates are pushed to us, no need for the updater. Several of them are handled at once
+            builder = builder.updater(None).concurrent_updates(config.concurrent_updates)
+        self.app: Application = builder.build()
 
         # for the access in handlers
         self.app.context_types.context.bot_data = {
             "creator_id": self.CREATOR_ID,
             'creator_username': self.CREATOR_USERNAME,
             'pubsub': self.pubsub,
-            'publish_to': self.publish_to
+            'publish_to': self.publish_to,
+            # merges short messages sent in a row, publishes to publish_to
+            'debouncer': Debouncer(config.coalesce_window, config.coalesce_max_wait, self.publish),
+            # replayed messages come without update and context, they are answered through the bot itself
+            'bot': self.app.bot,
+            # replies which are being edited while response is streamed, keyed by user message id
+            'streamed_replies': {},
+            'stream_edit_interval': config.stream_edit_interval,
+            # paces sends and edits per chat and for the whole bot, splits replies over telegram's limit
+            'outbox': Outbox('telegram', TELEGRAM_LIMIT,
+                             chat_rate=config.chat_rate, chat_burst=config.chat_burst,
+                             global_rate=config.global_rate, global_burst=config.global_burst,
+                             max_retries=config.send_retries, timeout=config.send_timeout,
+                             is_transient=is_transient_error, is_timeout=is_timeout_error)
         }
 
         self.job_queue = self.app.job_queue
         logger.info(f'[TelegramInterface/__init__] Subscribed to {self.subscribe_to}')
-        self.pubsub.subscribe(self.subscribe_to, send_message_from_pubsub)
+        self.pubsub.subscribe(self.subscribe_to, self.send_reply)
         # self.job_queue.run_repeating()
 
+    async def publish(self, message):
+        await self.pubsub.apublish(self.publish_to, message)
+
+    async def send_reply(self, message):
+        await send_message_from_pubsub(message, self.app.context_types.context.bot_data)
+
     def initialize(self):
         logger.info(f"[TelegramInterface/initialize] Initialization of telegram handlers.")
         filter_users = TypeHandler(Update, whitelist_user)
@@ -68,12 +99,39 @@ class TelegramInterface(BaseInterface):
         logger.info('[TelegramInterface/manage_even_loop] Created new event loop')
         return loop
 
+    async def run_webhook(self):
+        """Serves the webhook endpoint on this loop until the server stops"""
+        config = self.config
+        async with self.app:
+            await self.app.start()
+            if config.webhook_url:
+                await self.app.bot.set_webhook(url=config.webhook_url + config.webhook_path,
+                                               secret_token=config.webhook_secret,
+                                               allowed_updates=Update.ALL_TYPES,
+                                               drop_pending_updates=True)
+                logger.info(f"[TelegramInterface/run_webhook] Webhook set to {config.webhook_url}{config.webhook_path}")
+            else:
+                logger.info(f"[TelegramInterface/run_webhook] No webhook_url, updates have to be posted by hand")
+
+            web_app = create_webhook_app(self.app, config.webhook_path, config.webhook_secret)
+            server = uvicorn.Server(uvicorn.Config(web_app, host=config.webhook_listen, port=config.webhook_port,
+                                                   log_level='warning'))
+            logger.info(f"[TelegramInterface/run_webhook] Listening on "
+                        f"http://{config.webhook_listen}:{config.webhook_port}{config.webhook_path}")
+            try:
+                await server.serve()
+            finally:
+                await self.app.stop()
+
     def run(self):
         try:
             loop = self.manage_event_loop()
             self.initialize()
             logger.info(f"[Telegram/run] Starting an Application.")
-            loop.run_until_complete(self.app.run_polling(drop_pending_updates=True))
+            if self.config.mode == 'webhook':
+                loop.run_until_complete(self.run_webhook())
+            else:
+                loop.run_until_complete(self.app.run_polling(drop_pending_updates=True))
         except Exception as e:
             logger.exception("An error occurred in the bot thread: %s", e)
 
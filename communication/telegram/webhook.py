@@ -0,0 +1,43 @@
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from telegram import Update
+from telegram.ext import Application
+
+from . import logger
+
+# telegram sends the secret given to set_webhook in this header, so strangers can't push fake updates
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def create_webhook_app(application: Application, path: str = '/telegram', secret_token: Optional[str] = None) -> FastAPI:
+    """
+    Local endpoint telegram pushes updates to. Every update is processed in its own task, at most
+    concurrent_updates of the application at once, and telegram gets its response right away.
+    Must be served on the loop of the application.
+    Recorded updates can be replayed offline by POSTing their json here, see tests/telegram_webhook_test.py
+    """
+    app = FastAPI()
+
+    @app.post(path)
+    async def receive_update(request: Request) -> Response:
+        if secret_token and request.headers.get(SECRET_HEADER) != secret_token:
+            logger.warning(f"[webhook/receive_update] Update with a wrong secret token from {request.client}")
+            raise HTTPException(status_code=403, detail="Wrong secret token")
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except (ValueError, KeyError, TypeError) as e:
+            raise HTTPException(status_code=400, detail=f"Not an update: {e}")
+        if update is None:
+            raise HTTPException(status_code=400, detail="Empty update")
+
+        logger.debug(f"[webhook/receive_update] Got update {update.update_id}")
+        processor = application.update_processor
+        application.create_task(processor.process_update(update, application.process_update(update)), update=update)
+        return Response(status_code=200)
+
+    @app.get('/is_alive')
+    async def is_alive():
+        return {"status": "success"}
+
+    return app
@@ -1,5 +1,6 @@
-from .config_classes import SettingsManager, WeaviateSettings, TelegramSettings, LLMSettings, BrainSettings, DiscordSettings
+from .config_classes import SettingsManager, WeaviateSettings, TelegramSettings, LLMSettings, BrainSettings, DiscordSettings, MetricsSettings
 from .settings import (BACKUP_DIR,
+                       PUBSUB_LOG_DIR,
                        CONFIG_DIR,
                        PROFILES_DIR,
                        DEFAULT_SETTINGS,
@@ -31,10 +31,44 @@ class BaseSettings(BaseModel):
 class DiscordSettings(BaseSettings):
     bot_chat: int = -1  # Bot will only use dedicated chat for conversation
     creator_id: int = -1
+    stream_edit_interval: float = 1.0  # seconds between edits of a streamed reply
+    send_timeout: float = 10.0  # seconds for a single attempt to send a reply
+    send_retries: int = 3  # attempts after the first one, for timeouts and server errors
+    # every channel has its own token bucket, discord allows about 5 messages per 5 seconds in a channel
+    channel_rate: float = 1.0
+    channel_burst: int = 5
+    # shared by all channels
+    global_rate: float = 50.0
+    global_burst: int = 50
+    # messages of a channel which come within coalesce_window seconds of each other are published as one, 0 - off.
+    # The first one waits at most coalesce_max_wait seconds for the rest
+    coalesce_window: float = 0.0
+    coalesce_max_wait: float = 5.0
 
 
 class TelegramSettings(BaseSettings):
     creator_id: int = -1  # whitelist
+    stream_edit_interval: float = 1.0  # seconds between edits of a streamed reply
+    send_timeout: float = 10.0  # seconds for a single attempt to send a reply
+    send_retries: int = 3  # attempts after the first one, for flood limits, timeouts and network errors
+    # sends and edits per second, telegram allows about 1 message per second in a chat and 30 overall
+    chat_rate: float = 1.0
+    chat_burst: int = 3
+    global_rate: float = 30.0
+    global_burst: int = 30
+    # messages of a chat which come within coalesce_window seconds of each other are published as one, 0 - off.
+    # The first one waits at most coalesce_max_wait seconds for the rest
+    coalesce_window: float = 0.0
+    coalesce_max_wait: float = 5.0
+    # polling - bot asks telegram for updates, webhook - telegram pushes them to a local endpoint
+    mode: str = "polling"
+    webhook_listen: str = "127.0.0.1"
+    webhook_port: int = 8443
+    webhook_path: str = "/telegram"
+    # public https address which forwards to the local endpoint, registered with telegram on start. None - not registered
+    webhook_url: Optional[str] = None
+    webhook_secret: Optional[str] = None
+    concurrent_updates: int = 16  # updates handled at once in webhook mode
 
 
 class WeaviateSettings(BaseSettings):
@@ -52,6 +86,8 @@ class WeaviateSettings(BaseSettings):
     alpha: float = 0.5  # 1 pure vector search, 0 pure keyword search
     limit: int = 2
     sim_search_type: str = 'hybrid'
+    # chat(e.g. telegram:<chat id>) which gets memories saved before chats had their own history, None - they are left
+    legacy_session: Optional[str] = None
 
 
 @dataclass
@@ -82,6 +118,7 @@ class LLMSettings(BaseSettings):
     endpoint: Optional[str] = None
     seed: int | None = None
     stop: str | list[str] | None = field(default_factory=list)
+    cache_capacity_mb: int = 0  # size of the prompt(kv state) cache in RAM, 0 disables it
 
     @model_validator(mode='before')
     @classmethod
@@ -112,9 +149,32 @@ class LLMSettings(BaseSettings):
         return values
 
 
+class TopicSettings(BaseSettings):
+    max_size: int = 0  # 0 means unbounded
+    overflow: str = "block"  # block, drop_oldest or reject
+    reject_to: Optional[str] = None  # topic where a busy reply is published for rejected/dropped messages
+    busy_message: str = "I'm busy right now, try again in a moment."
+    durable: bool = False  # keep queued messages on disk, so they are processed after a crash/restart
+
+
 class PubSubSettings(BaseSettings):
     input_message_topic: str
     processed_message_topic: str
+    # queue limits per topic name, topics not listed here are unbounded
+    topics: Dict[str, TopicSettings] = {}
+    error_topic: str = "pubsub_error"  # failures of listeners are published here
+    drain_timeout: float = 30.0  # seconds to finish in-flight messages on stop
+    # local - everything runs in one process, socket - processes talk through a broker on a unix socket
+    transport: str = "local"
+    # None - raise_pubsub-<uid>/pubsub.sock in $XDG_RUNTIME_DIR or the temp dir. Its directory must be private(0700)
+    socket_path: Optional[str] = None
+    # durable topics, logs are written to disk commit_interval seconds after a change and split into files of segment_size_mb
+    commit_interval: float = 0.005
+    segment_size_mb: int = 16
+    # seconds a message waits before it is served like one of a higher priority, so attachments don't starve behind text
+    aging_interval: float = 5.0
+    # seconds between exports of per-topic stats(queue depth, rates, in-flight listeners) to metrics, 0 - off
+    stats_interval: float = 60.0
 
 
 class BrainSettings(BaseSettings):
@@ -124,6 +184,34 @@ class BrainSettings(BaseSettings):
     persona_path: str = "default_persona"
     creator_name: str = ""
     assistant_name: str = ""
+    # timeouts(in seconds) for each stage of message processing, None means no timeout
+    fetch_timeout: Optional[float] = 5
+    retrieve_timeout: Optional[float] = 5
+    generate_timeout: Optional[float] = 300
+    persist_timeout: Optional[float] = 10
+    # every chat has its own history, at most max_sessions are kept in memory
+    max_sessions: int = 32
+    session_idle_timeout: Optional[float] = 3600  # seconds
+    # memories are saved in batches in the background, kept in a local file if db is unreachable
+    write_behind: bool = True
+    write_behind_batch_size: int = 8
+    write_behind_flush_interval: float = 2.0  # seconds
+    write_behind_max_retries: int = 3
+    write_behind_retry_delay: float = 1.0  # seconds, doubled after every failed attempt
+    # messages processed at the same time, the rest wait for a free slot
+    max_concurrency: Optional[int] = 2
+    # messages processed or waiting, over this limit brain asks pubsub to stop admitting new ones
+    max_in_flight: Optional[int] = 4
+    # a new message cancels the answer to the previous one if nothing of it was sent, both are answered together
+    supersede: bool = False
+    # seconds between partial updates of a streamed response, interfaces edit the reply on each of them
+    stream_publish_interval: float = 0.5
+
+
+class MetricsSettings(BaseSettings):
+    enabled: bool = True
+    host: str = "127.0.0.1"
+    port: int = 9100
 
 
 class Config(BaseSettings):
@@ -133,6 +221,7 @@ class Config(BaseSettings):
     llm: Optional[LLMSettings] = None
     pubsub: Optional[PubSubSettings] = None
     brain: Optional[BrainSettings] = None
+    metrics: Optional[MetricsSettings] = None
     llm_type: str = None
 
 
@@ -171,6 +260,8 @@ class SettingsManager:
                 self.config.pubsub = PubSubSettings(**data['pubsub'])
             if 'brain' in data:
                 self.config.brain = BrainSettings(**data['brain'])
+            if 'metrics' in data:
+                self.config.metrics = MetricsSettings(**data['metrics'])
 
             # if 'plugins' in data:
             #     for name, settings in data['plugins'].items():
@@ -233,6 +324,8 @@ class SettingsManager:
             all_settings['pubsub'] = self.config.pubsub.dict()
         if self.config.brain:
             all_settings['brain'] = self.config.brain.dict()
+        if self.config.metrics:
+            all_settings['metrics'] = self.config.metrics.dict()
 
         # all_settings['plugins'] = {name: asdict(plugin) for name, plugin in self.config.plugins.items()}
         all_settings['llm_type'] = self.config.llm_type
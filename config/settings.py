@@ -25,6 +25,7 @@ SETTINGS_FROM_ENV = PROFILES_DIR / config_name
 # Assets
 ASSETS_DIR = BASE_DIR / "assets"
 BACKUP_DIR = ASSETS_DIR / "db_backups"
+PUBSUB_LOG_DIR = ASSETS_DIR / "pubsub_log"  # logs of durable topics, created when a topic is made durable
 MODEL_DIR = ASSETS_DIR / 'models'
 PERSONA_DIR = ASSETS_DIR / 'persona_description'
 PROMPT_TEMPLATES_DIR = ASSETS_DIR / "prompt_templates"
@@ -0,0 +1,48 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from utils import Message, merge_messages
+from . import logger
+from .session import SessionKey
+
+
+@dataclass
+class Generation:
+    """Answer to a (merged) message which is being worked on"""
+    message: Message
+    task: Optional[asyncio.Task] = None
+    # once the user saw a part of the answer it can't be taken back
+    visible: bool = False
+
+
+class Coalescer:
+    """
+    A new message of a chat supersedes the answer to the previous one if nothing of it was sent yet,
+    the previous message is then merged with the new one and answered together.
+    Bursts of messages are merged before they get here, by the Debouncer of the interface.
+    """
+
+    def __init__(self):
+        self.generations: Dict[SessionKey, Generation] = {}
+
+    def supersede(self, message: Message) -> Message:
+        """Cancels the unseen answer to the previous message of the chat, returns the message to answer"""
+        key = message.session_key
+        generation = self.generations.get(key)
+        if generation is None or generation.visible or generation.task is None or generation.task.done():
+            return message
+        logger.info(f"[Coalescer/supersede] New message in {key}, answering it together with the previous one")
+        generation.task.cancel()
+        del self.generations[key]
+        return merge_messages([generation.message, message])
+
+    def track(self, message: Message) -> Generation:
+        generation = Generation(message=message)
+        self.generations[message.session_key] = generation
+        return generation
+
+    def untrack(self, generation: Generation) -> None:
+        key = generation.message.session_key
+        if self.generations.get(key) is generation:
+            del self.generations[key]
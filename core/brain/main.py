@@ -1,11 +1,17 @@
+import asyncio
 import datetime
-from typing import Optional, List
+import time
+from dataclasses import replace
+from typing import Optional, List, Any, Coroutine, Callable, Tuple
 from jinja2 import Template
-from utils import Message
+from utils import Message, observe_stage, StageTimer, can_merge
 
 from . import logger, PERSONA_DIR, BrainSettings
-from ..memory import MemoryChain, Async_DB_Interface
+from ..memory import MemoryChain, Async_DB_Interface, WriteBehindMemory
 from .model_handler import Model
+from .token_ledger import TokenLedger
+from .session import ChatSession, SessionStore, SessionKey, session_name
+from .coalescer import Coalescer, Generation
 
 
 # add context search
@@ -25,11 +31,19 @@ class Brain(metaclass=Singleton):
                  pubsub: 'PubSub',
                  subscribe_to: str,
                  publish_to: str,
-                 token_limit: int = 2000  # possibly transfer this to llm settings?
+                 token_limit: int = 2000,  # possibly transfer this to llm settings?
+                 history_limit: int = 20
                  ):
         # memory_manager - db instance, persona - name of the file where persona is stored
         # Important classes
         self.memory_manager: 'Async_DB_Interface' = memory_manager
+        if config.write_behind:
+            # saving memories shouldn't wait for the db, they are written in batches in the background
+            self.memory_manager = WriteBehindMemory(memory_manager,
+                                                    batch_size=config.write_behind_batch_size,
+                                                    flush_interval=config.write_behind_flush_interval,
+                                                    max_retries=config.write_behind_max_retries,
+                                                    retry_delay=config.write_behind_retry_delay)
         self.model: Model = model
         self.pubsub: 'PubSub' = pubsub
         self.config: BrainSettings = config
@@ -38,34 +52,56 @@ class Brain(metaclass=Singleton):
         self.persona: Optional[str] = None
         self.template: Optional[Template] = None
         self.token_limit: int = token_limit
+        self.history_limit: int = history_limit
         self.receive_topic: str = subscribe_to
         self.publish_to_topic: str = publish_to
         self.is_loaded_model: bool = False
 
         # initialization
-        self.memories: List[dict] = list()
+        # every chat(interface, chat id) has its own chat history
+        self.sessions: SessionStore = SessionStore(factory=self._new_session,
+                                                   max_sessions=config.max_sessions,
+                                                   idle_timeout=config.session_idle_timeout)
+        # a new message of a chat takes over the unseen answer to the previous one, None when supersede is off
+        self.coalescer: Optional[Coalescer] = Coalescer() if config.supersede else None
         self.load_persona()
-        self.pubsub.subscribe(subscribe_to, self.process_message)
+        # several brain processes share incoming messages when pubsub runs over a socket transport
+        self.pubsub.subscribe(subscribe_to, self.process_message, max_concurrency=config.max_concurrency, group='brain')
+        self.pubsub.set_admission(subscribe_to, self.has_capacity)
+        self.pubsub.on_stop(self.astop)
 
     async def start(self):
-        self.load_model()
+        if self.load_model() and self.persona:
+            # persona is the same for every request, so its prompt evaluation can be reused
+            await self.model.warmup(self._system_messages())
         if self.config.use_memories:
-            logger.info(f"[Brain/start] initializing chat data/memories")
-            await self.fetch_chat_data()
+            logger.info(f"[Brain/start] chat data/memories are fetched when a chat sends its first message")
             return
         logger.info(f"[Brain/start] Not using chat data/memories")
 
-    def _add_to_chat_history(self, role: str, content: str):
-        logger.info(f"[Brain/_def_add_to_chat_history] Added message to chat history for {role}")
-        self.memories.append({
+    def _system_messages(self) -> List[dict]:
+        if not self.persona:
+            return []
+        return [{
+            'role': 'system',
+            'content': self.persona
+        }]
+
+    def _new_session(self, key: SessionKey) -> ChatSession:
+        return ChatSession(key=key, memories=self._system_messages(), ledger=TokenLedger(self.model))
+
+    def _add_to_chat_history(self, session: ChatSession, role: str, content: str):
+        logger.info(f"[Brain/_def_add_to_chat_history] Added message to chat history of {session.key} for {role}")
+        session.memories.append({
             'role': 'user' if role == "user" else "assistant",
             'content': content
         })
+        self._trim_history(session)
         # 1.1 checking if we use more tokens than allowed in prompt
-        curr_token = self.forget()
+        curr_token = self.forget(session)
         logger.info(f"[Brain/_def_add_to_chat_history] Current total number of tokens is {curr_token}")
 
-    async def _save_to_memory(self, message: Message):
+    async def _save_to_memory(self, session: ChatSession, message: Message, expected_version: Optional[int]):
         if not self.config.save_memories:
             logger.info(f"[Brain/_save_to_memory] Saving to memory ignored.")
             return
@@ -75,17 +111,38 @@ class Brain(metaclass=Singleton):
         mem_chain.add_object(
             from_name=message.from_user,
             message=message.text_content.content,
-            time=message.datetime
+            time=message.datetime,
+            session=session_name(session.key)
         )
         mem_chain.add_object(
             from_name=self.config.assistant_name,
             message=message.response_message,
-            time=datetime.datetime.now().astimezone()
+            time=datetime.datetime.now().astimezone(),
+            session=session_name(session.key)
         )
-        saved = await self.memory_manager.add_memories(memory_chain=mem_chain)
+        version = await self.memory_manager.add_memories(memory_chain=mem_chain)
 
-        if not saved:
+        if version is None:
             logger.error("[Brain/_save_to_memory] couldn't save memories")
+            return
+
+        if session.history_version != expected_version:
+            # chat history was refetched in the meantime, it is up-to-date already
+            return
+
+        # Our messages are already in the chat history, so cache stays valid as long as nobody else touched
+        # memories of this chat in the meantime. Writes of other chats don't change its version.
+        if expected_version is not None and version == expected_version + len(mem_chain.memories):
+            session.history_version = version
+            return
+        logger.info("[Brain/_save_to_memory] memories were changed elsewhere, invalidating chat history cache")
+        session.history_version = None
+
+    def has_capacity(self) -> bool:
+        """Admission hook for pubsub, new messages are shed once max_in_flight messages are processed or waiting."""
+        if self.config.max_in_flight is None:
+            return True
+        return self.pubsub.pending(self.receive_topic) < self.config.max_in_flight
 
     async def process_message(self, message: Message):
         if not self.is_loaded_model:
@@ -94,63 +151,182 @@ class Brain(metaclass=Singleton):
             self.pubsub.publish(self.publish_to_topic, message)
             return
 
-        # 0 Is to get last 20 memories.
-        # We delete cached chat data and fetch last 20 messages from the db.
-        # Maybe user used fastapi to delete memories? but they won't be updated here, hence the change.
-        await self._clear_and_fetch_chat_data()
+        if not self.coalescer or not can_merge(message):
+            await self._answer(message)
+            return
 
-        # 1. Getting current memories with user input
+        message = self.coalescer.supersede(message)
+        generation = self.coalescer.track(message)
+        generation.task = asyncio.ensure_future(self._answer(message, generation))
+        try:
+            await generation.task
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            # superseded, the message is answered together with a newer one
+        finally:
+            self.coalescer.untrack(generation)
+
+    async def _answer(self, message: Message, generation: Optional[Generation] = None):
         content = message.text_content.content
-        logger.debug(f'[Brain/process_message] Got message from {self.receive_topic}, content: {content}')
+        session = self.sessions.get(message.session_key)
+        logger.debug(f'[Brain/_answer] Got message from {self.receive_topic} for {session.key}, content: {content}')
+
+        # Messages of the same chat are processed in order, other chats are not blocked by this one.
+        async with session.lock:
+            did_add_context, built = False, False
+            try:
+                # 1. fetch + retrieve. They don't depend on each other, so both db calls run at the same time.
+                _, context_mem_chain = await asyncio.gather(
+                    self._run_stage('fetch', self._stage_fetch(session), self.config.fetch_timeout),
+                    self._run_stage('retrieve', self._stage_retrieve(content), self.config.retrieve_timeout),
+                )
+
+                # 2. build
+                with StageTimer('build'):
+                    did_add_context = self._stage_build(session, content, context_mem_chain)
+                built = True
+
+                # 3. generate
+                generated = await self._run_stage('generate', self._stage_generate(session, message, generation),
+                                                  self.config.generate_timeout)
+            except asyncio.CancelledError:
+                # superseded or stopped, chat history shouldn't keep a message which wasn't answered
+                if built:
+                    self._drop_last_input(session, content)
+                self._stage_cleanup(session, did_add_context)
+                raise
+            if not generated:
+                message.response_message = 'Something went wrong. No response was generated'
+                # unanswered input isn't saved, cached chat history has to stay the same as the stored one
+                self._drop_last_input(session, content)
+
+            # 4. cleanup, so that the next message starts from clean system prompt
+            self._stage_cleanup(session, did_add_context)
+            expected_version = session.history_version
+
+        # 5. publish, user gets the response before we start saving anything
+        if generation:
+            generation.visible = True
+        message.responded_at = time.perf_counter()
+        observe_stage('brain', message.responded_at - message.received_at)
+        self.pubsub.publish(self.publish_to_topic, message)
 
-        self._add_to_chat_history('user', content)
+        # 6. persist (optional)
+        if generated:
+            await self._run_stage('persist', self._save_to_memory(session, message, expected_version),
+                                  self.config.persist_timeout)
 
+    @staticmethod
+    async def _run_stage(name: str, coro: Coroutine, timeout: Optional[float]) -> Any:
+        """Runs a single pipeline stage, returns None if it failed or didn't finish in time."""
+        start_time = time.perf_counter()
+        try:
+            async with asyncio.timeout(timeout):
+                return await coro
+        except TimeoutError:
+            logger.error(f"[Brain/_run_stage] Stage '{name}' didn't finish in {timeout}s")
+        except Exception as e:
+            logger.error(f"[Brain/_run_stage] Stage '{name}' failed: {e}")
+        finally:
+            observe_stage(name, time.perf_counter() - start_time)
+        return None
+
+    async def _stage_fetch(self, session: ChatSession) -> None:
+        # Chat history is cached, we refetch it only if memories were changed outside the brain
+        # e.g. user used fastapi to delete memories. That is noticed by the version a save returns.
+        await self._sync_chat_data(session)
+
+    async def _stage_retrieve(self, content: str) -> Optional[MemoryChain]:
+        if not self.config.add_context:
+            return None
+        return await self.memory_manager.get_context(content)
+
+    def _stage_build(self, session: ChatSession, content: str, context_mem_chain: Optional[MemoryChain]) -> bool:
+        """Adds user input and context to the prompt. Returns True if context was added."""
         did_add_context = False
-        # 2. Getting context for user query.
-        # make it in separate function
         if self.config.add_context:
-            context_mem_chain = await self.memory_manager.get_context(content)
-            did_add_context = self._render_persona_with_context(context_mem_chain)
+            did_add_context = self._render_persona_with_context(session, context_mem_chain)
             if not did_add_context:
-                logger.info(f'[Brain/process_message] did not add any context to the system prompt.')
-
-        # 3. Response generation
-        logger.info(f"[Brain/process_message] Generating an llm response")
-        logger.debug(f"[Brain/process_message] Prompt: {self.memories}")
-        response_content, usage, generation_time = self.model.generate(self.memories)
+                logger.info(f'[Brain/_stage_build] did not add any context to the system prompt.')
+
+        self._add_to_chat_history(session, 'user', content)
+        return did_add_context
+
+    async def _stage_generate(self, session: ChatSession, message: Message,
+                              generation: Optional[Generation] = None) -> bool:
+        logger.info(f"[Brain/_stage_generate] Generating an llm response for {session.key}")
+        logger.debug(f"[Brain/_stage_generate] Prompt: {session.memories}")
+        on_token, stop_stream = None, None
+        if self.model.llm_settings.stream:
+            on_token, stop_stream = self._stream_publisher(message, generation)
+        try:
+            response_content, usage, generation_time = await self.model.agenerate(session.memories, on_token=on_token)
+        finally:
+            if stop_stream:
+                stop_stream()
         message.response_message = response_content.content
-        logger.info(f"[Brain/process_message] Received response from llm in {generation_time}s")
-        logger.debug(f"[Brain/process_message] Received response from llm usage: {usage}")
+        logger.info(f"[Brain/_stage_generate] Received response from llm in {generation_time:.3f}s")
+        logger.debug(f"[Brain/_stage_generate] Received response from llm usage: {usage}")
 
-        self._add_to_chat_history('assistant', response_content.content)
-
-        # 4. saving to memory (optional)
-        await self._save_to_memory(message)
+        self._add_to_chat_history(session, 'assistant', response_content.content)
+        return True
 
-        # 5. cleaning chat history (optional)
+    def _stream_publisher(self, message: Message, generation: Optional[Generation] = None
+                          ) -> Tuple[Callable[[str], None], Callable[[], None]]:
+        """
+        Returns callback that publishes the response generated so far as a partial update of the message,
+        the first token right away and then at most once per stream_publish_interval. _answer publishes the whole one.
+        Second one stops it, tokens which were already on their way to the loop when the generation was cancelled
+        or timed out are ignored then.
+        """
+        chunks: List[str] = []
+        published_at: Optional[float] = None
+        stopped = False
+
+        def on_token(text: str) -> None:
+            nonlocal published_at
+            if stopped:
+                return
+            chunks.append(text)
+            now = time.monotonic()
+            if published_at is not None and now - published_at < self.config.stream_publish_interval:
+                return
+            published_at = now
+            if generation:
+                generation.visible = True  # user sees the answer from now on, it can't be superseded
+            self.pubsub.publish(self.publish_to_topic,
+                                replace(message, response_message=''.join(chunks), is_partial=True))
+
+        def stop() -> None:
+            nonlocal stopped
+            stopped = True
+        return on_token, stop
+
+    def _stage_cleanup(self, session: ChatSession, did_add_context: bool) -> None:
         if not self.config.use_memories:
-            logger.info(f"[Brain/process_message] clearing chat info from history")
-            self._cmwsm()  # leaves only system prompt
+            logger.info(f"[Brain/_stage_cleanup] clearing chat info from history")
+            self._cmwsm(session)  # leaves only system prompt
 
         if did_add_context:
             # we want to delete current context for next message from system prompt
-            logger.info(f"[Brain/process_message] emptying context")
-            self.memories[0] = {
+            logger.info(f"[Brain/_stage_cleanup] emptying context")
+            session.memories[0] = {
                 'role': 'system',
                 'content': self.persona
             }
-            logger.info(f"empty context: {self.memories}")
+            logger.info(f"empty context: {session.memories}")
 
-        # 6. sending back to communication module
-        self.pubsub.publish(self.publish_to_topic, message)
+    async def astop(self):
+        """Runs on the pubsub loop when it stops, memories queued there are written while the loop still runs"""
+        if isinstance(self.memory_manager, WriteBehindMemory):
+            await self.memory_manager.drain()
 
     def close(self):
         if not self.model:
             logger.warning("[Brain/close] no model to close connection for")
             return False
-        self.model.llm.close()
-        del self.model.llm
-        self.model.llm = None
+        self.model.close()
         logger.info("[Brain/close] Successfully closed connection for model.")
 
     def load_model(self):
@@ -160,6 +336,8 @@ class Brain(metaclass=Singleton):
 
         is_loaded = self.model.load_model()
         self.is_loaded_model = is_loaded
+        for session in self.sessions:
+            session.ledger.reset()
         return is_loaded
 
     def load_persona(self) -> None:
@@ -174,23 +352,20 @@ class Brain(metaclass=Singleton):
 
             # Render the persona without context for initial loading
             self.persona = self.template.render(context=None)
-
-            self.memories.append({
-                'role': 'system',
-                'content': self.persona
-            })
+            # sessions were created with the old persona
+            self.sessions.clear()
             logger.debug(f'[Brain/load_persona] loaded persona is {self.persona}')
         except IOError:
             logger.error(f"[Brain/load_persona] There was an error during handling the file {self.persona}")
         else:
             logger.info(f"[Brain/load_persona] Successfully loaded AI persona")
 
-    def _render_persona_with_context(self, memory_chain: Optional[MemoryChain] = None) -> bool:
+    def _render_persona_with_context(self, session: ChatSession, memory_chain: Optional[MemoryChain] = None) -> bool:
         """return True if rendered prompt successfully"""
         if not self.template:
             logger.error("[Brain/_render_persona_with_context] No persona template loaded.")
             return False
-        if self.memories[0].get('role', '') != 'system':
+        if not session.memories or session.memories[0].get('role', '') != 'system':
             logger.warning("[Brain/_render_persona_with_context] There is no system message in chat history")
             return False
         if not memory_chain:
@@ -220,30 +395,59 @@ class Brain(metaclass=Singleton):
         rendered_persona = self.template.render(context=context)
         logger.info("[Brain/_render_persona_with_context] Successfully rendered system prompt with context.")
 
-        self.memories[0] = {
+        session.memories[0] = {
             'role': 'system',
             'content': rendered_persona
         }
         logger.info("[Brain/_render_persona_with_context] Successfully replaced system message in chat history")
-        self.forget()
+        self.forget(session)
         return True
 
-    async def _clear_and_fetch_chat_data(self):
-        self._cmwsm()
+    async def _sync_chat_data(self, session: ChatSession):
+        """Fetch chat history only if there is no valid cached one, _save_to_memory invalidates it."""
+        if not self.config.use_memories:
+            self._cmwsm(session)
+            return
+
+        if session.history_version is not None:
+            logger.info(f"[Brain/_sync_chat_data] chat history cache of {session.key} is up to date "
+                        f"(version {session.history_version})")
+            return
+
+        await self._clear_and_fetch_chat_data(session)
+
+    async def _clear_and_fetch_chat_data(self, session: ChatSession):
+        self._cmwsm(session)
         if self.config.use_memories:
             logger.info(f"[Brain/_clear_and_fetch_chat_data] fetching chat data")
-            await self.fetch_chat_data()
+            await self.fetch_chat_data(session)
+
+    @staticmethod
+    def _drop_last_input(session: ChatSession, content: str):
+        if session.memories and session.memories[-1] == {'role': 'user', 'content': content}:
+            session.memories.pop()
 
-    def _cmwsm(self):
+    @staticmethod
+    def _cmwsm(session: ChatSession):
         """clear messages without system messages"""
-        self.memories = [memory for memory in self.memories if memory['role'] == 'system']
+        session.memories = [memory for memory in session.memories if memory['role'] == 'system']
 
-    async def fetch_chat_data(self) -> None:
+    def _trim_history(self, session: ChatSession):
+        """keep at most history_limit messages besides the system one, same as a fresh fetch would return"""
+        excess = len(session.memories) - 1 - self.history_limit
+        if excess > 0:
+            del session.memories[1:1 + excess]
+
+    async def fetch_chat_data(self, session: ChatSession) -> None:
         try:
-            logger.info(f"[Brain/fetch_chat_data] Fetching chat memories")
-            fetchedMemories: MemoryChain = await self.memory_manager.get_chat_memory()
+            logger.info(f"[Brain/fetch_chat_data] Fetching chat memories for {session.key}")
+            # version is taken before fetching, so changes made during the fetch invalidate cache next time
+            version = await self.memory_manager.get_memory_version(session_name(session.key))
+            fetchedMemories: MemoryChain = await self.memory_manager.get_chat_memory(self.history_limit,
+                                                                                     session_name(session.key))
         except Exception as e:
             logger.error(f'[Brain/fetch_chat_data] Brain was damaged, could not remember anything {e}')
+            session.history_version = None
             return
 
         if not fetchedMemories:
@@ -251,25 +455,31 @@ class Brain(metaclass=Singleton):
             return
 
         for memory in fetchedMemories.memories:
-            self.memories.append({
+            session.memories.append({
                 'role': 'user' if self.config.creator_name == memory.from_name else 'assistant',
                 'content': memory.message
             })
 
-        curr_tokens_amount = self.forget()  # forgets last message in a chat history if necessary
+        session.history_version = version
+        curr_tokens_amount = self.forget(session)  # forgets last message in a chat history if necessary
         logger.info(f"[Brain/fetch_chat_data] Current total number of tokens is {curr_tokens_amount}")
         logger.info(f"[Brain/fetch_chat_data] Successfully fetched memories.")
 
-    def forget(self) -> int:
+    def forget(self, session: ChatSession) -> int:
         """returns total number of tokens at the end"""
-        prompt = self.model.format_prompt(self.memories)
+        # 1. cheap pass using cached per-message token counts
+        estimated_tokens = session.ledger.trim(session.memories, self.token_limit)
+        logger.debug(f"[Brain/forget] estimated number of tokens: {estimated_tokens}")
+
+        # 2. final check on the whole prompt, tokens can merge on message boundaries
+        prompt = self.model.format_prompt(session.memories)
         logger.debug(f"[Brain/forget] prompt after formatting: {prompt}")
         curr_total_tokens = self.model.count_tokens(prompt)
 
-        while curr_total_tokens > self.token_limit:
+        while curr_total_tokens > self.token_limit and len(session.memories) > 1:
             logger.info(
-                f"Brain/forget] Forgetting last message in the chat history. Current lengths of memories {len(self.memories)}")
-            self.memories.pop(1)
-            prompt = self.model.format_prompt(self.memories)
+                f"[Brain/forget] Estimate was off, forgetting last message in the chat history. Current lengths of memories {len(session.memories)}")
+            session.memories.pop(1)
+            prompt = self.model.format_prompt(session.memories)
             curr_total_tokens = self.model.count_tokens(prompt)
         return curr_total_tokens
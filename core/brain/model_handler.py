@@ -1,11 +1,17 @@
+import asyncio
+import functools
+import threading
+import time
 import yaml
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Callable, Dict, Tuple
 
 from jinja2 import Template
-from llama_cpp import Llama
+from llama_cpp import Llama, LlamaRAMCache, StoppingCriteriaList
 
+from utils import observe_stage, TOKENS_PER_SECOND
 from . import LLMSettings, logger, MODEL_DIR, ResponseContent, Usage, PROMPT_TEMPLATES_DIR
 
 DEFAULT_TEMPLATE = PROMPT_TEMPLATES_DIR / "llama-2.yaml"
@@ -16,10 +22,12 @@ class Model:
         self.llm_settings = llm_settings
         self.llm: Optional[Union['Llama', str]] = None
         self.prompt_template_name = self.llm_settings.chat_format
-        self.prompt_template = None
         self._eos_token = None
         self._bos_token = None
+        self.prompt_template = None
         self.template_source = None
+        # llama.cpp context isn't thread safe, so every generation goes through this single thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='llm')
 
     def load_model(self):
         if self.llm_settings.local:
@@ -44,6 +52,10 @@ class Model:
                              n_batch=self.llm_settings.n_batch,
                              # chat_format=self.llm_settings.chat_format,
                              verbose=self.llm_settings.verbose)
+            if self.llm_settings.cache_capacity_mb > 0:
+                # keeps kv state of previous prompts, next prompt continues from the longest common token prefix
+                self.llm.set_cache(LlamaRAMCache(capacity_bytes=self.llm_settings.cache_capacity_mb << 20))
+                logger.info(f"[Model/_load_model_local] Using prompt cache of {self.llm_settings.cache_capacity_mb}MB")
             self.initialize_tokens()
             self.load_prompt_template()
             logger.info(f"[Model/_load_model_local] Template source: {self.template_source}")
@@ -58,16 +70,22 @@ class Model:
         """TODO for future. ping endpoint to check if alive and add that endpoint to self.llm"""
         raise NotImplemented
 
-    def _generate_remote(self, messages: List[dict]):
+    def _generate_remote(self, messages: List[dict],
+                         cancel_event: Optional[threading.Event] = None,
+                         on_token: Optional[Callable[[str], None]] = None):
         raise NotImplemented
 
     # noinspection PyTypeChecker
-    def _generate_local(self, messages: List[dict]):
+    def _generate_local(self, messages: List[dict],
+                        cancel_event: Optional[threading.Event] = None,
+                        on_token: Optional[Callable[[str], None]] = None):
 
         formatted_prompt = self.format_prompt(messages)
         logger.debug(f"[Model/_generate_local] formatted_prompt {formatted_prompt}")
         logger.debug(f"[Model/_generate_local] settings {self.llm_settings}")
-        stat_time = datetime.now()
+        # Streamed responses tell prompt evaluation and token generation apart, whole ones report exact usage
+        stream = self.llm_settings.stream
+        start_time = time.perf_counter()
         response = self.llm.create_completion(
             prompt=formatted_prompt,
             temperature=self.llm_settings.temperature,
@@ -75,41 +93,222 @@ class Model:
             top_k=self.llm_settings.top_k,
             min_p=self.llm_settings.min_p,
             typical_p=self.llm_settings.typical_p,
-            stream=self.llm_settings.stream,
+            stream=stream,
             stop=self.llm_settings.stop,
             max_tokens=self.llm_settings.max_tokens,
             repeat_penalty=self.llm_settings.repeat_penalty,
-            seed=self.llm_settings.seed
-        )
-        end_time = datetime.now()
-        generation_time = int((end_time - stat_time).total_seconds())
-
-        # created = response['created']  # unix time
-        choices = response['choices'][0]
-        response_content = ResponseContent(
-            content=choices['text'],
-            finish_reason=choices['finish_reason']
+            seed=self.llm_settings.seed,
+            # checked after every token, lets agenerate stop the generation midway
+            stopping_criteria=StoppingCriteriaList([lambda input_ids, logits: cancel_event.is_set()])
+            if cancel_event else None
         )
-        usage = Usage(**response['usage'])
+        if not stream:
+            generation_time = time.perf_counter() - start_time
+            choices = response['choices'][0]
+            response_content = ResponseContent(content=choices['text'], finish_reason=choices['finish_reason'])
+            usage = Usage(**response['usage'])
+            logger.debug(f'[Model/_generate_local] generated this response {response_content.content}')
+            logger.info(f"[Model/_generate_local] Generated message with {usage.completion_tokens} tokens in "
+                        f"{generation_time:.3f}s")
+            return response_content, usage, generation_time
+
+        response_content, usage, first_token_time = self._consume_stream(response, formatted_prompt, on_token)
+        end_time = time.perf_counter()
+        generation_time = end_time - start_time
+
+        prompt_eval_time = (first_token_time or end_time) - start_time
+        token_generation_time = end_time - (first_token_time or end_time)
+        observe_stage('prompt_eval', prompt_eval_time)
+        observe_stage('token_generation', token_generation_time)
+        if usage.completion_tokens > 1 and token_generation_time > 0:
+            # first token is produced together with prompt evaluation
+            TOKENS_PER_SECOND.observe((usage.completion_tokens - 1) / token_generation_time)
+
         logger.debug(f'[Model/_generate_local] generated this response {response_content.content}')
-        logger.info(f"[Model/_generate_local] Generated message with {usage.completion_tokens} tokens in {generation_time}s ")
+        logger.info(f"[Model/_generate_local] Generated message with {usage.completion_tokens} tokens in "
+                    f"{generation_time:.3f}s (prompt eval {prompt_eval_time:.3f}s)")
 
         return response_content, usage, generation_time
 
-    def generate(self, messages: List[dict]):
+    def _consume_stream(self, response, formatted_prompt: str, on_token: Optional[Callable[[str], None]] = None):
+        """
+        Collects streamed chunks into a single response. Streamed responses don't report usage, so we count it.
+        Also returns perf_counter time of the first chunk.
+        """
+        content = ''
+        finish_reason = None
+        first_token_time = None
+        for chunk in response:
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+            choices = chunk['choices'][0]
+            finish_reason = choices['finish_reason'] or finish_reason
+            if not choices['text']:
+                continue
+            content += choices['text']
+            if on_token:
+                on_token(choices['text'])
+
+        prompt_tokens = self.count_tokens(formatted_prompt)
+        # a chunk can hold several tokens(e.g. a multibyte character), so they are counted by the tokenizer
+        completion_tokens = len(self.llm.tokenize(content.encode('utf-8'), add_bos=False)) if content else 0
+        usage = Usage(prompt_tokens=prompt_tokens,
+                      completion_tokens=completion_tokens,
+                      total_tokens=prompt_tokens + completion_tokens)
+        return ResponseContent(content=content, finish_reason=finish_reason), usage, first_token_time
+
+    def generate(self, messages: List[dict],
+                 cancel_event: Optional[threading.Event] = None,
+                 on_token: Optional[Callable[[str], None]] = None):
         logger.debug(f"[Model/generate] prompt for generation {messages}")
         if self.llm_settings.local:
             logger.info(f'[Model/generate] Proceeding generate text locally')
-            return self._generate_local(messages)
+            return self._generate_local(messages, cancel_event, on_token)
         logger.info(f'[Model/generate] Proceeding to generate text remotely')
-        return self._generate_remote(messages)
-
-    def _supports_system_role(self) -> bool:
+        return self._generate_remote(messages, cancel_event, on_token)
+
+    async def agenerate(self, messages: List[dict], on_token: Optional[Callable[[str], None]] = None):
+        """
+        Same as generate, but runs in the model's executor thread so the calling event loop stays free.
+        Cancelling the awaiting task stops the generation after the current token.
+        When streaming, on_token is called with every generated chunk on the calling event loop.
+        """
+        cancel_event = threading.Event()
+        loop = asyncio.get_running_loop()
+        if on_token:
+            callback = on_token
+            on_token = lambda text: loop.call_soon_threadsafe(callback, text)
+        future = loop.run_in_executor(self.executor,
+                                      functools.partial(self.generate, list(messages), cancel_event, on_token))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            logger.info(f'[Model/agenerate] Generation was cancelled, stopping llm')
+            cancel_event.set()
+            raise
+
+    def _warmup_local(self, prompt: str) -> None:
+        # same as create_completion does it, chat template markers have to be single tokens for the cache to match
+        tokens = self.llm.tokenize(prompt.encode('utf-8'), special=True)
+        start_time = datetime.now()
+        self.llm.reset()
+        self.llm.eval(tokens)
+        if self.llm.cache is not None:
+            self.llm.cache[tokens] = self.llm.save_state()
+        logger.info(f"[Model/_warmup_local] Evaluated {len(tokens)} prompt tokens in "
+                    f"{(datetime.now() - start_time).total_seconds():.2f}s")
+
+    async def warmup(self, messages: List[dict]) -> None:
+        """
+        Evaluates prompt of given messages (usually only the persona) ahead of time,
+        so that the first request only has to evaluate what comes after it.
+        """
+        if not self.llm_settings.local or not self.llm:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self._warmup_local, self.format_prompt(messages))
+        except Exception as e:
+            logger.error(f"[Model/warmup] Couldn't warm up the model: {e}")
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        if self.llm:
+            self.llm.close()
+        self.llm = None
+
+    @property
+    def prompt_template(self) -> Optional[str]:
+        return self._prompt_template
+
+    @prompt_template.setter
+    def prompt_template(self, value: Optional[str]) -> None:
+        self._prompt_template = value
+        self._invalidate_template()
+
+    def _invalidate_template(self) -> None:
+        """Compiled template depends on template source and bos/eos tokens, it is rebuilt on the next use."""
+        self._compiled_template: Optional[Template] = None
+        self._system_role_supported: bool = False
+        self._append_safe: bool = False
+        self._template_head: str = ''
+        self._generation_suffix: str = ''
+        self._piece_cache: Dict[Tuple[str, str], str] = {}
+
+    def _render(self, messages: List[dict], add_generation_prompt=False) -> str:
+        return self._compiled_template.render(messages=messages,
+                                              bos_token=self._bos_token,
+                                              eos_token=self._eos_token,
+                                              add_generation_prompt=add_generation_prompt,
+                                              raise_exception=template_exception)
+
+    def _compile_template(self) -> None:
         if not self.prompt_template:
             raise Exception("No template loaded.")
 
-        unsupported_roles_pattern = "system"
-        return unsupported_roles_pattern in self.prompt_template
+        self._compiled_template = Template(self.prompt_template)
+        self._system_role_supported = "system" in self.prompt_template
+        self._template_head = self._render([])
+        self._generation_suffix = self._render([], add_generation_prompt=True)[len(self._template_head):]
+        self._append_safe = self._check_append_safe()
+        logger.info(f"[Model/_compile_template] Compiled prompt template, "
+                    f"system role: {self._system_role_supported}, incremental rendering: {self._append_safe}")
+
+    def _check_append_safe(self) -> bool:
+        """
+        Template can be rendered incrementally if rendering each message on its own and gluing them together
+        gives the same prompt as rendering the whole conversation. Checked on a sample conversation.
+        """
+        sample = [
+            {'role': 'system', 'content': 'sample system'},
+            {'role': 'user', 'content': 'sample user 1'},
+            {'role': 'assistant', 'content': 'sample assistant 1'},
+            {'role': 'user', 'content': 'sample user 2'},
+            {'role': 'assistant', 'content': 'sample assistant 2'},
+        ]
+        if not self._system_role_supported:
+            sample = preprocess_messages(sample)
+
+        try:
+            pieces = []
+            for message in sample:
+                rendered = self._render([message])
+                if not rendered.startswith(self._template_head):
+                    return False
+                pieces.append(rendered[len(self._template_head):])
+
+            for i in range(1, len(sample) + 1):
+                glued = self._template_head + ''.join(pieces[:i])
+                if self._render(sample[:i]) != glued:
+                    return False
+                if self._render(sample[:i], add_generation_prompt=True) != glued + self._generation_suffix:
+                    return False
+        except Exception as e:
+            logger.debug(f"[Model/_check_append_safe] Template can't be rendered incrementally: {e}")
+            return False
+        return True
+
+    def _supports_system_role(self) -> bool:
+        if self._compiled_template is None:
+            self._compile_template()
+        return self._system_role_supported
+
+    def append_to_prompt(self, prompt: str, message: dict) -> Optional[str]:
+        """
+        Appends a single message to an already rendered prompt(without generation prompt).
+        Returns None if the template can't be rendered incrementally.
+        """
+        if self._compiled_template is None:
+            self._compile_template()
+        if not self._append_safe:
+            return None
+
+        key = (message['role'], message['content'])
+        piece = self._piece_cache.get(key)
+        if piece is None:
+            piece = self._render([message])[len(self._template_head):]
+            self._piece_cache[key] = piece
+        return prompt + piece
 
     def format_prompt(self, messages: List[dict], add_generation_prompt=False):
         if not self.prompt_template:
@@ -119,13 +318,18 @@ class Model:
             logger.info("[Model/format_prompt] System role unsupported; filtering 'system' messages.")
             messages = preprocess_messages(messages)
 
-        template = Template(self.prompt_template)
+        if not self._append_safe:
+            return self._render(messages, add_generation_prompt)
+
+        if len(self._piece_cache) > 4 * len(messages) + 64:
+            # drop pieces of messages which are long gone from the chat history
+            self._piece_cache = {}
 
-        formatted_prompt = template.render(messages=messages,
-                                           bos_token=self._bos_token,
-                                           eos_token=self._eos_token,
-                                           add_generation_prompt=add_generation_prompt,
-                                           raise_exception=template_exception)
+        formatted_prompt = self._template_head
+        for message in messages:
+            formatted_prompt = self.append_to_prompt(formatted_prompt, message)
+        if add_generation_prompt:
+            formatted_prompt += self._generation_suffix
         return formatted_prompt
 
     def count_tokens(self, prompt: str) -> int:
@@ -197,6 +401,7 @@ class Model:
             self._bos_token = (self.llm._model.token_get_text(bos_token_id) if bos_token_id != -1 else "")
         except Exception as e:
             logger.debug(f"[Model/initialize_tokens] Got an unexpected error {e}")
+        self._invalidate_template()
 
     def _load_default_template(self):
         logger.info("[Model/_load_default_template] Loading default template.")
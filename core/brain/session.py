@@ -0,0 +1,85 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Hashable, List, Optional, Tuple
+
+from . import logger
+from .token_ledger import TokenLedger
+
+SessionKey = Tuple[str, Optional[Hashable]]  # (interface, chat id)
+
+
+def session_name(key: SessionKey) -> str:
+    """how the session is stored with memories, e.g. 'telegram:123'"""
+    return f"{key[0]}:{key[1]}"
+
+
+@dataclass
+class ChatSession:
+    key: SessionKey
+    memories: List[dict]
+    ledger: TokenLedger
+    # version of stored memories that memories reflect, None means cache is invalid
+    history_version: Optional[int] = None
+    # messages of a single chat are processed one by one, different chats don't wait for each other
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    last_used: float = field(default_factory=time.monotonic)
+
+    def touch(self) -> None:
+        self.last_used = time.monotonic()
+
+
+class SessionStore:
+    """LRU of live chat sessions. Sessions over capacity or idle for too long are evicted, unless they are busy."""
+
+    def __init__(self,
+                 factory: Callable[[SessionKey], ChatSession],
+                 max_sessions: int = 32,
+                 idle_timeout: Optional[float] = None):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions: OrderedDict[SessionKey, ChatSession] = OrderedDict()
+
+    def get(self, key: SessionKey) -> ChatSession:
+        self._evict_idle()
+
+        session = self.sessions.get(key)
+        if session is None:
+            logger.info(f"[SessionStore/get] Creating new session for {key}")
+            session = self.factory(key)
+            self.sessions[key] = session
+            self._evict_over_capacity()
+        else:
+            self.sessions.move_to_end(key)
+        session.touch()
+        return session
+
+    def clear(self) -> None:
+        self.sessions.clear()
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+    def _evict_idle(self) -> None:
+        if self.idle_timeout is None:
+            return
+        now = time.monotonic()
+        for key, session in list(self.sessions.items()):
+            if now - session.last_used > self.idle_timeout and not session.lock.locked():
+                logger.info(f"[SessionStore/_evict_idle] Evicting idle session {key}")
+                del self.sessions[key]
+
+    def _evict_over_capacity(self) -> None:
+        # oldest first, busy sessions and the newest one are skipped
+        for key, session in list(self.sessions.items())[:-1]:
+            if len(self.sessions) <= self.max_sessions:
+                return
+            if session.lock.locked():
+                continue
+            logger.info(f"[SessionStore/_evict_over_capacity] Evicting least recently used session {key}")
+            del self.sessions[key]
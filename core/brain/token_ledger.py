@@ -0,0 +1,56 @@
+from typing import Dict, List, Tuple
+
+from . import logger
+
+
+class TokenLedger:
+    """Keeps per-message token counts so chat history can be trimmed without re-tokenizing the whole prompt."""
+
+    def __init__(self, model: 'Model'):
+        self.model: 'Model' = model
+        self._counts: Dict[Tuple[str, str], int] = {}
+        self._overhead: int | None = None
+
+    @property
+    def overhead(self) -> int:
+        """Tokens the template adds around an empty conversation (bos token etc.)."""
+        if self._overhead is None:
+            self._overhead = self.model.count_tokens(self.model.format_prompt([]))
+        return self._overhead
+
+    def count(self, message: dict) -> int:
+        key = (message['role'], message['content'])
+        if key not in self._counts:
+            rendered = self.model.format_prompt([message])
+            self._counts[key] = max(self.model.count_tokens(rendered) - self.overhead, 0)
+        return self._counts[key]
+
+    def total(self, messages: List[dict]) -> int:
+        return self.overhead + sum(self.count(message) for message in messages)
+
+    def trim(self, messages: List[dict], token_limit: int) -> int:
+        """
+        Drops the oldest non-system messages (index 1 onwards) in place until the estimate fits into token_limit.
+        Returns estimated total number of tokens.
+        """
+        counts = [self.count(message) for message in messages]
+        curr_total_tokens = self.overhead + sum(counts)
+
+        while curr_total_tokens > token_limit and len(messages) > 1:
+            logger.info(
+                f"[TokenLedger/trim] Forgetting last message in the chat history. Current lengths of memories {len(messages)}")
+            messages.pop(1)
+            curr_total_tokens -= counts.pop(1)
+
+        self._prune(messages)
+        return curr_total_tokens
+
+    def reset(self) -> None:
+        """Should be called when the prompt template or tokenizer changes."""
+        self._counts.clear()
+        self._overhead = None
+
+    def _prune(self, messages: List[dict]) -> None:
+        """Keep only counts for messages which are still in the history."""
+        alive = {(message['role'], message['content']) for message in messages}
+        self._counts = {key: value for key, value in self._counts.items() if key in alive}
@@ -1,25 +1,239 @@
 import asyncio
+import concurrent.futures
+import pickle
 import threading
-from dataclasses import dataclass, field
-from typing import Callable, Dict, List, Any, Coroutine, Type
-from utils import Message
-from config import logger
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Any, Coroutine, Type, Optional, Set, Iterable, Tuple
+from utils import Message, observe_stage, metrics, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from config import logger, PUBSUB_LOG_DIR
+from .transport import Transport, LocalTransport, strip_local_fields
+from .durable_log import DurableLog
+
+
+# max number of messages a consumer takes from its queue before letting other topics run
+MAX_BURST = 64
+
+# what happens to a published message when the topic queue is full or the consumer has no capacity
+# apublish waits for room, publish can't wait and parks the message in an unbounded overflow buffer of the topic
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # the oldest waiting message of the lowest priority is thrown away
+OVERFLOW_REJECT = 'reject'  # the new message is thrown away, sender gets a busy reply
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT)
+
+DEFAULT_BUSY_MESSAGE = "I'm busy right now, try again in a moment."
+# seconds request waits for its reply by default, a reply lost in another process can't be noticed otherwise
+DEFAULT_REQUEST_TIMEOUT = 600.0
+DEFAULT_ERROR_TOPIC = 'pubsub_error'
+
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    'raise_pubsub_queue_wait_seconds', 'Time messages waited in the topic queue.', label='topic')
+HANDLER_SECONDS = metrics.histogram(
+    'raise_pubsub_handler_seconds', 'Time listeners took to handle a message.', label='topic')
+# updated every stats_interval seconds
+QUEUE_DEPTH = metrics.gauge('raise_pubsub_queue_depth', 'Messages waiting in the topic queue.', label='topic')
+IN_FLIGHT = metrics.gauge('raise_pubsub_in_flight', 'Listener tasks which are running.', label='topic')
+OLDEST_RUNNING = metrics.gauge(
+    'raise_pubsub_oldest_running_seconds', 'How long the oldest running listener task runs, finds stuck listeners.',
+    label='topic')
+MESSAGE_COUNTERS = ('enqueued', 'dequeued', 'handled', 'failed', 'dropped', 'rejected')
+MESSAGES = {name: metrics.counter(f'raise_pubsub_{name}_total', f'Messages {name} by the topic.', label='topic')
+            for name in MESSAGE_COUNTERS}
+LISTENER_ERRORS = metrics.counter(
+    'raise_pubsub_listener_errors_total', 'Listener failures which reached the error topic.', label='listener')
+
+
+class _Lanes:
+    """Storage of LaneQueue, len is the number of messages in all lanes"""
+
+    def __init__(self, count: int):
+        self.lanes: List[deque] = [deque() for _ in range(count)]
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class LaneQueue(asyncio.Queue):
+    """
+    asyncio.Queue with a FIFO lane per message priority. get serves the highest lane first, but every aging_interval
+    seconds spent in the queue a message is ranked one lane higher, so a backlog of high priority messages
+    can't starve the rest. Items are (published_at, message, ...) tuples.
+    """
+
+    def __init__(self, maxsize: int = 0, aging_interval: float = 5.0):
+        self.aging_interval = aging_interval
+        self._dropping = False
+        super().__init__(maxsize)
+
+    def drop(self) -> Any:
+        """Removes the oldest item of the lowest lane, for load shedding"""
+        self._dropping = True
+        try:
+            return self.get_nowait()
+        finally:
+            self._dropping = False
+
+    def _init(self, maxsize: int) -> None:
+        self._queue = _Lanes(PRIORITY_LOW - PRIORITY_HIGH + 1)
+
+    def _put(self, item: tuple) -> None:
+        priority = getattr(item[1], 'priority', PRIORITY_NORMAL)
+        lane = min(max(priority, PRIORITY_HIGH), PRIORITY_LOW) - PRIORITY_HIGH
+        self._queue.lanes[lane].append(item)
+        self._queue.size += 1
+
+    def _get(self) -> tuple:
+        lanes = self._queue.lanes
+        if self._dropping:
+            chosen = max(index for index, lane in enumerate(lanes) if lane)
+        else:
+            now = time.perf_counter()
+            chosen, best_rank = None, None
+            for index, lane in enumerate(lanes):
+                if not lane:
+                    continue
+                rank = index - (now - lane[0][0]) / self.aging_interval
+                if best_rank is None or rank < best_rank:
+                    chosen, best_rank = index, rank
+        self._queue.size -= 1
+        return lanes[chosen].popleft()
+
+
+class RequestDropped(Exception):
+    """Message of a request was rejected or dropped by a full topic without a busy reply, no reply will come"""
+
+
+@dataclass
+class Subscription:
+    handler: Callable[[Any], Coroutine]
+    # None means every message gets its own task right away
+    max_concurrency: Optional[int] = None
+    semaphore: Optional[asyncio.Semaphore] = None
+    # running listener task -> time.perf_counter() when it was started
+    tasks: Dict[asyncio.Task, float] = field(default_factory=dict)
+
+    def __post_init__(self):
+        if self.max_concurrency:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+
+@dataclass
+class ListenerError:
+    """Published to the error topic when a listener raises."""
+    topic: str
+    listener: str
+    message: Any
+    error: str
+
+
+async def record_listener_error(error: ListenerError) -> None:
+    """
+    Sink for the error topic, counts failures per listener. With a socket transport it gets failures
+    of every process, so subscribe it with a group to see each of them once.
+    """
+    LISTENER_ERRORS.inc(1, error.listener)
+    logger.warning(f"[record_listener_error] {error.listener} failed on a message of {error.topic} topic: {error.error}")
+
+
+@dataclass
+class PendingRequest:
+    topic: str
+    # concurrent future, so that the reply can be awaited from any event loop
+    future: concurrent.futures.Future = field(default_factory=concurrent.futures.Future)
+
+
+@dataclass
+class TopicStats:
+    """Counters of a topic, see MESSAGE_COUNTERS. Only touched on the PubSub loop."""
+    enqueued: int = 0
+    dequeued: int = 0
+    handled: int = 0
+    failed: int = 0
+    dropped: int = 0
+    rejected: int = 0
+    # messages per second over the last stats_interval, None until the first export
+    enqueue_rate: Optional[float] = None
+    dequeue_rate: Optional[float] = None
+    created_at: float = field(default_factory=time.perf_counter)
+    sampled_at: float = field(default_factory=time.perf_counter)
+    # counter values at the last export
+    exported: Dict[str, int] = field(default_factory=dict)
 
 
 @dataclass
 class Topic:
-    queue: asyncio.Queue = None
-    listeners: List[Callable[[Any], Coroutine]] = field(default_factory=list)
+    queue: LaneQueue = None
+    listeners: List[Subscription] = field(default_factory=list)
+    consumer: Optional[asyncio.Task] = None
+    # with a remote transport, processes subscribed with the same group share messages of this topic
+    group: Optional[str] = None
+    # durable topics keep every queued message on disk until all listeners are done with it
+    log: Optional[DurableLog] = None
+    # offset -> listeners still working on it, 0 while the message waits in the queue
+    unsettled: Dict[int, int] = field(default_factory=dict)
+    # overflow buffer of the block policy: puts waiting for room in a full queue, unbounded.
+    # Newer messages queue up behind them to keep the order
+    blocked_puts: Set[asyncio.Task] = field(default_factory=set)
+    overflow: str = OVERFLOW_BLOCK
+    # rejected and dropped messages are published here with a busy reply, so that the interface can answer the user
+    reject_to: Optional[str] = None
+    busy_message: str = DEFAULT_BUSY_MESSAGE
+    # returns False when listeners can't take more work right now, called from the PubSub loop
+    admission: Optional[Callable[[], bool]] = None
+    stats: TopicStats = field(default_factory=TopicStats)
 
 
 class PubSub:
-    def __init__(self, message_type: Type[Message] = Message, pooling_delay: float = 0.5):
+    def __init__(self,
+                 message_type: Type[Message] = Message,
+                 pooling_delay: float = 0.5,
+                 error_topic: str = DEFAULT_ERROR_TOPIC,
+                 drain_timeout: float = 30.0,
+                 transport: Optional[Transport] = None,
+                 log_dir: Path = PUBSUB_LOG_DIR,
+                 commit_interval: float = 0.005,
+                 segment_size: int = 16 * 1024 * 1024,
+                 aging_interval: float = 5.0,
+                 stats_interval: float = 60.0):
         self.channels: Dict[str, Topic] = {}
         self.message_type = message_type
+        self.error_topic = error_topic
+        # on stop, seconds to wait for queued messages and running listeners before they are cancelled
+        self.drain_timeout = drain_timeout
+        # correlation id -> request waiting for its reply
+        self._requests: Dict[str, PendingRequest] = {}
+        # Not used anymore, every topic has a consumer waiting on its queue. Left for compatibility.
         self.pooling_delay = pooling_delay
         self.loop = asyncio.new_event_loop()
         self._thread = None
+        self._loop_thread_id: Optional[int] = None
+        # messages published from other threads wait here, the loop takes all of them with a single wakeup
+        self._inbox: deque = deque()
+        self._inbox_lock = threading.Lock()
+        self._inbox_scheduled = False
+        self._running = False
         self.stop_event = asyncio.Event()
+        # carries messages to other processes, by default everything stays in this one
+        self.transport: Transport = transport or LocalTransport()
+        self.transport.attach(self)
+        # durable topics, the log is flushed once something was appended or settled, commit_interval seconds later,
+        # so that everything which happened in between is written together
+        self.log_dir = Path(log_dir)
+        self.commit_interval = commit_interval
+        self._logs_dirty = asyncio.Event()
+        self.segment_size = segment_size
+        # seconds a message waits before it is served like a message of one lane higher priority
+        self.aging_interval = aging_interval
+        self._committer: Optional[asyncio.Task] = None
+        # seconds between exports of topic stats to metrics, 0 turns the export off
+        self.stats_interval = stats_interval
+        self._stats_exporter: Optional[asyncio.Task] = None
+        # awaited on the loop once messages are drained on stop, see on_stop
+        self._stop_hooks: List[Callable[[], Awaitable[None]]] = []
 
     def start(self):
         logger.info(f"[PubSub/start] Starting worker thread")
@@ -31,6 +245,7 @@ class PubSub:
         logger.info(f"[PubSub/_start_loop] Starting worker loop")
         """Set up the event loop to run in the thread."""
         asyncio.set_event_loop(self.loop)
+        self._loop_thread_id = threading.get_ident()
         try:
             self.loop.run_until_complete(self.start_working())
         except RuntimeError:
@@ -40,24 +255,257 @@ class PubSub:
             logger.info("[PubSub/_start_loop] Worker loop stopped and event loop closed")
 
     async def start_working(self) -> None:
-        """Continuously check and process messages from topics."""
+        """Start a consumer for every topic and wait until PubSub is stopped."""
         logger.info("[PubSub/start_working] Entering main working loop")
+        self._running = True
         try:
-            while not self.stop_event.is_set():  # Async check with asyncio.Event
-                for topic, topic_data in self.channels.items():
-                    if not topic_data.queue.empty():
-                        message = await topic_data.queue.get()
-                        listeners = topic_data.listeners
-                        await self._propagate_to_listeners(listeners, message)
-                        topic_data.queue.task_done()
-                await asyncio.sleep(self.pooling_delay)
+            for topic in list(self.channels):
+                self._start_consumer(topic)
+            await self._replay()
+            if self._durable_topics():
+                self._committer = self.loop.create_task(self._group_commit())
+            if self.stats_interval:
+                self._stats_exporter = self.loop.create_task(self._export_stats())
+            await self.transport.start()
+            await self.stop_event.wait()
+            await self._drain()
+            await self._run_stop_hooks()
         except asyncio.CancelledError:
             logger.error("[PubSub/start_working] Loop cancelled during shutdown")
         except RuntimeError:
             logger.error("[PubSub/start_working] Event loop stopped before Future completed.")
         finally:
+            self._running = False
+            consumers = [topic_data.consumer for topic_data in self.channels.values() if topic_data.consumer]
+            leftovers = self.tasks() + [task for topic_data in self.channels.values() for task in topic_data.blocked_puts]
+            for task in consumers + leftovers:
+                task.cancel()
+            await asyncio.gather(*consumers, *leftovers, return_exceptions=True)
+            for task in (self._committer, self._stats_exporter):
+                if task:
+                    task.cancel()
+            self._close_logs()  # messages which didn't finish are replayed on the next start
+            await self.transport.stop()
             logger.info("[PubSub/start_working] Exiting main working loop")
 
+    async def _drain(self) -> None:
+        """Lets consumers and listeners finish what was already published, at most drain_timeout seconds."""
+        deadline = self.loop.time() + self.drain_timeout
+        while True:
+            tasks = self.tasks()
+            if not tasks and all(topic_data.queue.empty() and not topic_data.blocked_puts
+                                 for topic_data in self.channels.values()):
+                logger.info("[PubSub/_drain] All messages were processed")
+                return
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                logger.warning(f"[PubSub/_drain] {len(tasks)} listeners didn't finish in time, cancelling them")
+                return
+            if tasks:
+                await asyncio.wait(tasks, timeout=remaining)
+            else:
+                await asyncio.sleep(0.01)  # consumers are still picking up queued messages
+
+    def tasks(self) -> List[asyncio.Task]:
+        """Registry of listener tasks which haven't finished yet."""
+        return [task for topic_data in list(self.channels.values())
+                for subscription in topic_data.listeners for task in subscription.tasks]
+
+    def pending(self, topic: str) -> int:
+        """Number of messages of the topic that listeners are processing or waiting to process."""
+        topic_data = self.channels.get(topic)
+        if not topic_data:
+            return 0
+        in_queue = topic_data.queue.qsize() if any(s.semaphore for s in topic_data.listeners) else 0
+        return in_queue + sum(len(subscription.tasks) for subscription in topic_data.listeners)
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Live numbers of every topic: queue depth, message counters and rates, queue wait and handler duration
+        histograms, running listener tasks and how long the oldest of them runs. Can be called from any thread.
+        """
+        if self._running and threading.get_ident() != self._loop_thread_id:
+            return asyncio.run_coroutine_threadsafe(self._stats_on_loop(), self.loop).result(timeout=5)
+        return self._collect_stats()
+
+    async def _stats_on_loop(self) -> Dict[str, dict]:
+        return self._collect_stats()
+
+    def _collect_stats(self) -> Dict[str, dict]:
+        now = time.perf_counter()
+        queue_wait, handler_seconds = QUEUE_WAIT_SECONDS.snapshot(), HANDLER_SECONDS.snapshot()
+        result = {}
+        for topic, topic_data in list(self.channels.items()):
+            stats = topic_data.stats
+            # before the first export rates are averaged since the topic was created
+            elapsed = max(now - stats.created_at, 1e-9)
+            listeners = [{
+                'listener': getattr(subscription.handler, '__qualname__', repr(subscription.handler)),
+                'max_concurrency': subscription.max_concurrency,
+                'in_flight': len(subscription.tasks),
+                'oldest_running_seconds': now - min(subscription.tasks.values()) if subscription.tasks else 0.0,
+            } for subscription in topic_data.listeners]
+            result[topic] = {
+                'queue_depth': topic_data.queue.qsize(),
+                'blocked_publishers': len(topic_data.blocked_puts),
+                'in_flight': sum(listener['in_flight'] for listener in listeners),
+                'oldest_running_seconds': max((listener['oldest_running_seconds'] for listener in listeners),
+                                              default=0.0),
+                **{name: getattr(stats, name) for name in MESSAGE_COUNTERS},
+                'enqueue_rate': stats.enqueue_rate if stats.enqueue_rate is not None else stats.enqueued / elapsed,
+                'dequeue_rate': stats.dequeue_rate if stats.dequeue_rate is not None else stats.dequeued / elapsed,
+                'queue_wait': queue_wait.get(topic),
+                'handler_seconds': handler_seconds.get(topic),
+                'listeners': listeners,
+            }
+        return result
+
+    async def _export_stats(self) -> None:
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self._sample_stats()
+
+    def _sample_stats(self) -> None:
+        """Updates rates and pushes topic stats to metrics"""
+        now = time.perf_counter()
+        for topic, data in self._collect_stats().items():
+            stats = self.channels[topic].stats
+            elapsed = max(now - stats.sampled_at, 1e-9)
+            stats.enqueue_rate = (stats.enqueued - stats.exported.get('enqueued', 0)) / elapsed
+            stats.dequeue_rate = (stats.dequeued - stats.exported.get('dequeued', 0)) / elapsed
+            stats.sampled_at = now
+            for name in MESSAGE_COUNTERS:
+                value = getattr(stats, name)
+                MESSAGES[name].inc(value - stats.exported.get(name, 0), topic)
+                stats.exported[name] = value
+            QUEUE_DEPTH.set(data['queue_depth'], topic)
+            IN_FLIGHT.set(data['in_flight'], topic)
+            OLDEST_RUNNING.set(data['oldest_running_seconds'], topic)
+            logger.debug(f"[PubSub/_sample_stats] {topic}: depth {data['queue_depth']}, "
+                         f"in flight {data['in_flight']}, in {stats.enqueue_rate:.2f}/s, "
+                         f"out {stats.dequeue_rate:.2f}/s, failed {stats.failed}")
+
+    def _durable_topics(self) -> List[Topic]:
+        return [topic_data for topic_data in self.channels.values() if topic_data.log]
+
+    async def _replay(self) -> None:
+        """Queues messages which were published before the last stop/crash, but not processed by every listener"""
+        for topic, topic_data in list(self.channels.items()):
+            if not topic_data.log:
+                continue
+            replayed = 0
+            for offset, payload in topic_data.log.replay():
+                try:
+                    message = pickle.loads(payload)
+                except Exception as e:
+                    logger.error(f"[PubSub/_replay] Skipping damaged message {offset} of {topic} topic: {e}")
+                    continue
+                topic_data.unsettled[offset] = 0
+                await topic_data.queue.put((time.perf_counter(), message, offset))
+                topic_data.stats.enqueued += 1
+                replayed += 1
+            if replayed:
+                logger.info(f"[PubSub/_replay] Replayed {replayed} messages of {topic} topic")
+
+    async def _group_commit(self) -> None:
+        while True:
+            await self._logs_dirty.wait()  # idle logs don't wake the loop
+            await asyncio.sleep(self.commit_interval)
+            self._logs_dirty.clear()
+            try:
+                self._commit_logs()
+            except OSError as e:
+                logger.error(f"[PubSub/_group_commit] Couldn't write topic logs: {e}")
+
+    def _commit_logs(self) -> None:
+        for topic_data in self._durable_topics():
+            log = topic_data.log
+            # everything before the oldest message someone is still working on is done
+            log.commit(min(topic_data.unsettled) - 1 if topic_data.unsettled else log.next_offset - 1)
+            log.flush()
+
+    def _close_logs(self) -> None:
+        try:
+            self._commit_logs()
+        except OSError as e:
+            logger.error(f"[PubSub/_close_logs] Couldn't write topic logs: {e}")
+        for topic_data in self._durable_topics():
+            topic_data.log.close()
+            topic_data.log = None
+
+    def _append(self, topic: str, topic_data: Topic, message: Any) -> Optional[int]:
+        """Saves the message to the topic log, returns its offset. None if the topic isn't durable."""
+        if topic_data.log is None or getattr(message, 'is_partial', False):
+            # partial updates of a stream are outdated by the time of a replay
+            return None
+        try:
+            record = strip_local_fields(message) if isinstance(message, Message) else message
+            offset = topic_data.log.append(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.error(f"[PubSub/_append] Couldn't save message of {topic} topic, it won't survive a restart: {e}")
+            return None
+        if offset is not None:
+            topic_data.unsettled[offset] = 0
+            self._logs_dirty.set()
+        return offset
+
+    def _listener_done(self, topic_data: Topic, offset: Optional[int]) -> None:
+        if offset is None or offset not in topic_data.unsettled:
+            return
+        topic_data.unsettled[offset] -= 1
+        if topic_data.unsettled[offset] <= 0:
+            del topic_data.unsettled[offset]
+            self._logs_dirty.set()
+
+    def _start_consumer(self, topic: str) -> None:
+        """Must be called from the PubSub loop."""
+        topic_data = self.channels.get(topic)
+        if not topic_data or topic_data.consumer:
+            return
+        logger.info(f"[PubSub/_start_consumer] Starting consumer for {topic} topic")
+        topic_data.consumer = self.loop.create_task(self._consume(topic, topic_data))
+
+    async def _consume(self, topic: str, topic_data: Topic) -> None:
+        """Waits on the topic queue and hands messages to listeners as soon as they arrive."""
+        queue = topic_data.queue
+        while True:
+            # listeners with max_concurrency get a slot before the message leaves the queue,
+            # so the backlog waits in the lanes and the next free slot goes to the most urgent message
+            reserved = await self._reserve_slots(topic_data)
+            item = await queue.get()
+            # drain whatever else is waiting without going back to the loop for every message
+            burst = 0
+            while True:
+                published_at, message, offset = item
+                waited = time.perf_counter() - published_at
+                observe_stage('queue_wait', waited)
+                QUEUE_WAIT_SECONDS.observe(waited, topic)
+                topic_data.stats.dequeued += 1
+                self._propagate_to_listeners(topic, topic_data, message, offset, reserved)
+                queue.task_done()
+                burst += 1
+                if burst >= MAX_BURST:
+                    burst = 0
+                    await asyncio.sleep(0)  # long burst, let other topics run
+                if queue.empty() or not self._slots_free(topic_data):
+                    break
+                reserved = await self._reserve_slots(topic_data)  # slots are free, doesn't wait
+                item = queue.get_nowait()
+
+    @staticmethod
+    async def _reserve_slots(topic_data: Topic) -> List[Subscription]:
+        reserved = []
+        for subscription in list(topic_data.listeners):
+            if subscription.semaphore is not None:
+                await subscription.semaphore.acquire()
+                reserved.append(subscription)
+        return reserved
+
+    @staticmethod
+    def _slots_free(topic_data: Topic) -> bool:
+        return all(subscription.semaphore is None or not subscription.semaphore.locked()
+                   for subscription in topic_data.listeners)
+
     async def _shutdown(self):
         self.stop_event.set()
         # tasks = [t for t in asyncio.all_tasks(self.loop) if not t.done()]
@@ -68,49 +516,357 @@ class PubSub:
         # except Exception as e:
         #     logger.warning(f"[PubSub/_shutdown] Exception during shutdown: {e}")
 
+    def on_stop(self, hook: Callable[[], Awaitable[None]]) -> None:
+        """
+        hook is awaited on the PubSub loop once published messages are processed on stop, before the loop goes away.
+        For listeners which leave background work on this loop(e.g. memory writes of the brain).
+        """
+        self._stop_hooks.append(hook)
+
+    async def _run_stop_hooks(self) -> None:
+        for hook in self._stop_hooks:
+            try:
+                async with asyncio.timeout(self.drain_timeout):
+                    await hook()
+            except Exception as e:
+                logger.error(f"[PubSub/_run_stop_hooks] Stop hook {getattr(hook, '__qualname__', hook)} failed: {e!r}")
+
     def stop(self):
         logger.info(f"[PubSub/stop] Stopping PubSub system")
         future = asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)  # Stop async tasks
         future.result()
+        if self._thread:
+            # start_working drains in-flight messages and returns on its own, loop is stopped only if it got stuck
+            logger.info(f"[PubSub/stop] Waiting for PubSub thread to finish in-flight messages")
+            self._thread.join(self.drain_timeout + 5)
+            if not self._thread.is_alive():
+                return
         logger.info(f"[PubSub/stop] Stopping PubSub loop")
         self.loop.call_soon_threadsafe(self.loop.stop)
         if self._thread:
             logger.info(f"[PubSub/stop] Stopping PubSub thread")
             self._thread.join()
 
-    def subscribe(self, topic: str, handler: Callable[[Any], Coroutine]) -> None:
-        """Subscribe a handler to a given topic."""
+    def _get_or_create_topic(self, topic: str) -> Topic:
         if topic not in self.channels:
-            topic_cls = Topic(queue=asyncio.Queue())
-            logger.info(f"[PubSub/subscribe] creating a new topic {topic}")
-            self.channels[topic] = topic_cls
-        logger.info(f"[PubSub/subscribe] subscribed to a {topic}")
-        self.channels[topic].listeners.append(handler)
+            logger.info(f"[PubSub/_get_or_create_topic] creating a new topic {topic}")
+            self.channels[topic] = Topic(queue=LaneQueue(aging_interval=self.aging_interval))
+            if self._running:
+                self.loop.call_soon_threadsafe(self._start_consumer, topic)
+        return self.channels[topic]
+
+    def configure_topic(self,
+                        topic: str,
+                        max_size: int = 0,
+                        overflow: str = OVERFLOW_BLOCK,
+                        reject_to: Optional[str] = None,
+                        busy_message: str = DEFAULT_BUSY_MESSAGE,
+                        durable: bool = False) -> None:
+        """
+        Limits how many messages can wait in the topic queue, 0 means unbounded.
+        overflow decides what happens to a message published to a full queue, see OVERFLOW_POLICIES.
+        durable topics keep messages in a log under log_dir, ones not processed before a crash are replayed on start.
+        Should be called before PubSub is started.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}', expected one of {OVERFLOW_POLICIES}")
+
+        topic_data = self._get_or_create_topic(topic)
+        if topic_data.queue.maxsize != max_size:
+            if not topic_data.queue.empty():
+                logger.warning(f"[PubSub/configure_topic] {topic} queue is not empty, keeping its old size")
+            else:
+                topic_data.queue = LaneQueue(maxsize=max_size, aging_interval=self.aging_interval)
+        topic_data.overflow = overflow
+        topic_data.reject_to = reject_to
+        topic_data.busy_message = busy_message
+        if durable and topic_data.log is None:
+            topic_data.log = DurableLog(self.log_dir / topic, self.segment_size)
+        logger.info(f"[PubSub/configure_topic] {topic}: max_size={max_size or 'unbounded'}, overflow={overflow}")
+
+    def set_admission(self, topic: str, admission: Optional[Callable[[], bool]]) -> None:
+        """
+        admission() is asked before every message is queued. When it returns False the topic is treated as full,
+        so listeners can shed load before the queue fills up. None removes the hook.
+        """
+        self._get_or_create_topic(topic).admission = admission
+
+    def subscribe(self,
+                  topic: str,
+                  handler: Callable[[Any], Coroutine],
+                  max_concurrency: Optional[int] = None,
+                  group: Optional[str] = None) -> None:
+        """
+        Subscribe a handler to a given topic.
+        At most max_concurrency messages are handled at once, the rest wait for a free slot in order.
+        group only matters with a remote transport: processes in the same group get messages of the topic in turns,
+        without a group the process gets all of them.
+        """
+        topic_data = self._get_or_create_topic(topic)
+        logger.info(f"[PubSub/subscribe] subscribed to a {topic}, max concurrency: {max_concurrency or 'unlimited'}")
+        topic_data.listeners.append(Subscription(handler=handler, max_concurrency=max_concurrency))
+        if len(topic_data.listeners) == 1 or (group and group != topic_data.group):
+            topic_data.group = group or topic_data.group
+            self.transport.subscribe(topic, topic_data.group)
 
     def publish(self, topic: str, message: Message) -> None:
-        """Publish a message in a thread-safe way."""
+        """
+        Publish a message in a thread-safe way. Never waits, with the block policy a message published to a full
+        topic waits in its overflow buffer, which is unbounded. Use apublish to wait for room instead.
+        """
+        if self._resolve_request(topic, message):
+            return
+        if self.transport.is_remote:
+            # listeners may live in other processes, broker sends the message back if this one listens too
+            self.transport.publish(topic, message)
+            return
         if topic not in self.channels:
             logger.warning(f"[PubSub/publish] publishing to a topic no one listens to. Ignoring")
             return
-        logger.info(f'[PubSub/publish] Publishing to a {topic} topic.')
-        task = self.channels[topic].queue.put(message)
-        asyncio.run_coroutine_threadsafe(task, self.loop)
+        logger.debug(f'[PubSub/publish] Publishing to a {topic} topic.')
+        self._submit([(topic, message, time.perf_counter())])
+
+    async def apublish(self, topic: str, message: Message) -> None:
+        """
+        Same as publish, but if the topic is full and its overflow policy is block, waits until the message is queued.
+        That's the backpressure of the block policy, publishers which can wait should use this one.
+        Can be awaited from any event loop. With a remote transport it doesn't wait, the broker doesn't know
+        about queues of other processes.
+        """
+        if self.transport.is_remote or not self._running or topic not in self.channels:
+            self.publish(topic, message)
+            return
+        if threading.get_ident() == self._loop_thread_id:
+            await self._publish_and_wait(topic, message)
+            return
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._publish_and_wait(topic, message), self.loop))
+
+    async def _publish_and_wait(self, topic: str, message: Message) -> None:
+        if self._resolve_request(topic, message):
+            return
+        blocked = self._enqueue(topic, message, time.perf_counter())
+        if blocked:
+            # cancelled publisher doesn't take the message back, it is queued anyway
+            await asyncio.shield(blocked)
+
+    def publish_many(self, topic: str, messages: Iterable[Message]) -> None:
+        """Publish several messages at once, from another thread they cost a single wakeup of the PubSub loop."""
+        if self.transport.is_remote:
+            for message in messages:
+                self.publish(topic, message)
+            return
+        if topic not in self.channels:
+            logger.warning(f"[PubSub/publish_many] publishing to a topic no one listens to. Ignoring")
+            return
+        now = time.perf_counter()
+        items = [(topic, message, now) for message in messages if not self._resolve_request(topic, message)]
+        logger.debug(f'[PubSub/publish_many] Publishing {len(items)} messages to a {topic} topic.')
+        self._submit(items)
+
+    def _submit(self, items: List[Tuple[str, Any, float]]) -> None:
+        """items are (topic, message, published at). Queued right away on the loop thread, batched from others."""
+        if threading.get_ident() == self._loop_thread_id:
+            for topic, message, published_at in items:
+                self._enqueue(topic, message, published_at)
+            return
+
+        with self._inbox_lock:
+            self._inbox.extend(items)
+            if self._inbox_scheduled:
+                return  # loop wasn't woken up for the previous messages yet, it takes these with them
+            self._inbox_scheduled = True
+        try:
+            self.loop.call_soon_threadsafe(self._drain_inbox)
+        except RuntimeError:
+            logger.warning(f"[PubSub/_submit] PubSub loop is closed, {len(items)} messages are lost")
+
+    def _drain_inbox(self) -> None:
+        with self._inbox_lock:
+            items, self._inbox = self._inbox, deque()
+            self._inbox_scheduled = False
+        for topic, message, published_at in items:
+            self._enqueue(topic, message, published_at)
+
+    async def request(self, topic: str, message: Message,
+                      timeout: Optional[float] = DEFAULT_REQUEST_TIMEOUT) -> Message:
+        """
+        Publishes message and waits for its reply, the first final message with the same correlation id
+        published to any other topic. The reply goes only to the caller, listeners of its topic don't get it.
+        Partial replies are still published as usual. Can be awaited from any event loop.
+        Raises TimeoutError if there is no reply in timeout seconds. Fails right away with the error of the listener
+        if it raised, with RequestDropped if the message was rejected or dropped and the topic has no reject_to.
+        That is known only in this process, with a remote transport the timeout is the only limit.
+        With a remote transport this process has to be subscribed to the topic of the reply, otherwise it never gets it.
+        """
+        if not self.transport.is_remote and topic not in self.channels:
+            raise LookupError(f"No one listens to {topic} topic")
+        if message.correlation_id is None:
+            message.correlation_id = uuid.uuid4().hex
+
+        pending = PendingRequest(topic=topic)
+        self._requests[message.correlation_id] = pending
+        self.publish(topic, message)
+        try:
+            async with asyncio.timeout(timeout):
+                return await asyncio.wrap_future(pending.future)
+        except TimeoutError:
+            logger.warning(f"[PubSub/request] No reply to {message.correlation_id} from {topic} in {timeout}s")
+            raise
+        finally:
+            self._requests.pop(message.correlation_id, None)
+            pending.future.cancel()
+
+    def _fail_request(self, topic: str, message: Any, error: Exception) -> None:
+        """Request waiting for a reply to message of the topic won't get one, it raises error right away"""
+        correlation_id = getattr(message, 'correlation_id', None)
+        pending = self._requests.get(correlation_id)
+        if pending is None or pending.topic != topic:
+            return
+        self._requests.pop(correlation_id, None)
+        if pending.future.set_running_or_notify_cancel():
+            pending.future.set_exception(error)
+
+    def _resolve_request(self, topic: str, message: Any) -> bool:
+        correlation_id = getattr(message, 'correlation_id', None)
+        if correlation_id is None or getattr(message, 'is_partial', False):
+            return False
+        pending = self._requests.get(correlation_id)
+        if pending is None or pending.topic == topic:
+            return False
+        self._requests.pop(correlation_id, None)
+        if pending.future.set_running_or_notify_cancel():
+            pending.future.set_result(message)
+        return True
+
+    def _deliver(self, topic: str, message: Any) -> None:
+        """
+        Entry for messages which came from the transport, called on the PubSub loop. Doesn't wait for room,
+        with the block policy the message waits in the overflow buffer, so other topics keep getting theirs.
+        """
+        if self._resolve_request(topic, message):
+            return
+        self._enqueue(topic, message, time.perf_counter())
+
+    def _enqueue(self, topic: str, message: Any, published_at: float) -> Optional[asyncio.Task]:
+        """Must be called from the PubSub loop. Returns the put task if the message has to wait for room."""
+        topic_data = self.channels.get(topic)
+        if topic_data is None:
+            logger.debug(f"[PubSub/_enqueue] Got message for {topic}, but no one listens to it anymore")
+            self._fail_request(topic, message, LookupError(f"No one listens to {topic} topic"))
+            return None
+
+        queue = topic_data.queue
+        admitted = topic_data.admission is None or topic_data.admission()
+        if admitted and not queue.full() and not topic_data.blocked_puts:
+            queue.put_nowait((published_at, message, self._append(topic, topic_data, message)))
+            topic_data.stats.enqueued += 1
+            return None
+
+        if topic_data.overflow == OVERFLOW_REJECT:
+            topic_data.stats.rejected += 1
+            logger.warning(f"[PubSub/_enqueue] {topic} is overloaded, message was rejected")
+            self._send_busy_reply(topic, topic_data, message)
+            return None
+        if topic_data.overflow == OVERFLOW_DROP_OLDEST and not queue.empty():
+            _, dropped, dropped_offset = queue.drop()
+            queue.task_done()
+            topic_data.unsettled.pop(dropped_offset, None)
+            topic_data.stats.dropped += 1
+            logger.warning(f"[PubSub/_enqueue] {topic} is overloaded, dropped the oldest message")
+            self._send_busy_reply(topic, topic_data, dropped)
+
+        # block, messages over capacity simply wait until there is room for them
+        item = (published_at, message, self._append(topic, topic_data, message))
+        topic_data.stats.enqueued += 1
+        if not queue.full() and not topic_data.blocked_puts:
+            queue.put_nowait(item)
+            return None
+        task = self.loop.create_task(queue.put(item))
+        topic_data.blocked_puts.add(task)
+        task.add_done_callback(topic_data.blocked_puts.discard)
+        return task
+
+    def _send_busy_reply(self, topic: str, topic_data: Topic, message: Message) -> None:
+        if not topic_data.reject_to or topic_data.reject_to == topic:
+            # busy reply would have answered a request, without it the request has to be failed
+            self._fail_request(topic, message, RequestDropped(f"{topic} is overloaded, message wasn't processed"))
+            return
+        self.publish(topic_data.reject_to, replace(message, response_message=topic_data.busy_message))
 
-    async def _propagate_to_listeners(self, listeners: List[Callable[[Any], Coroutine]], message: Message):
+    def _propagate_to_listeners(self, topic: str, topic_data: Topic, message: Message,
+                                offset: Optional[int] = None, reserved: List[Subscription] = ()) -> None:
         """Send the message to all registered listeners for a topic."""
-        for listener in listeners:
-            # await listener(message)
-            if asyncio.iscoroutinefunction(listener):
-                asyncio.create_task(listener(message))
+        listeners = topic_data.listeners
+        if offset is not None:
+            topic_data.unsettled[offset] = len(listeners) + 1
+        for subscription in reserved:
+            if subscription not in listeners:
+                subscription.semaphore.release()  # unsubscribed while the slot was reserved
+        for subscription in listeners:
+            if asyncio.iscoroutinefunction(subscription.handler):
+                task = self.loop.create_task(self._run_listener(topic, topic_data, subscription, message, offset,
+                                                                subscription in reserved))
+                # keeping a reference, otherwise the task can be garbage collected before it is done
+                subscription.tasks[task] = time.perf_counter()
+                task.add_done_callback(lambda done, tasks=subscription.tasks: tasks.pop(done, None))
             else:
-                logger.warning(f"[PubSub/_propagate_to_listeners] Listener is not a coroutine: {listener}")
-                listener(message)
+                logger.warning(f"[PubSub/_propagate_to_listeners] Listener is not a coroutine: {subscription.handler}")
+                started_at = time.perf_counter()
+                try:
+                    subscription.handler(message)
+                    topic_data.stats.handled += 1
+                except Exception as e:
+                    topic_data.stats.failed += 1
+                    self._report_failure(topic, subscription, message, e)
+                HANDLER_SECONDS.observe(time.perf_counter() - started_at, topic)
+                if subscription in reserved:
+                    subscription.semaphore.release()
+                self._listener_done(topic_data, offset)
+        # the extra count keeps the offset unsettled while listeners are being started
+        self._listener_done(topic_data, offset)
+
+    async def _run_listener(self, topic: str, topic_data: Topic, subscription: Subscription, message: Message,
+                            offset: Optional[int], holds_slot: bool = False) -> None:
+        started_at = time.perf_counter()
+        try:
+            if subscription.semaphore is not None and not holds_slot:
+                await subscription.semaphore.acquire()  # subscribed after the consumer reserved slots
+                holds_slot = True
+                started_at = time.perf_counter()
+            await subscription.handler(message)
+            topic_data.stats.handled += 1
+            HANDLER_SECONDS.observe(time.perf_counter() - started_at, topic)
+        except asyncio.CancelledError:
+            raise  # cancelled on stop, message stays unsettled and is replayed on the next start
+        except Exception as e:
+            topic_data.stats.failed += 1
+            HANDLER_SECONDS.observe(time.perf_counter() - started_at, topic)
+            # failed messages are not replayed, they would most likely fail again
+            self._report_failure(topic, subscription, message, e)
+        finally:
+            if holds_slot:
+                subscription.semaphore.release()
+        self._listener_done(topic_data, offset)
+
+    def _report_failure(self, topic: str, subscription: Subscription, message: Message, error: Exception) -> None:
+        name = getattr(subscription.handler, '__qualname__', repr(subscription.handler))
+        logger.error(f"[PubSub/_report_failure] Listener {name} of {topic} topic failed: {error!r}")
+        # request handled by this listener won't get a reply, fail it right away instead of waiting for timeout
+        self._fail_request(topic, message, error)
+        if topic == self.error_topic or (not self.transport.is_remote and self.error_topic not in self.channels):
+            return
+        self.publish(self.error_topic, ListenerError(topic=topic, listener=name, message=message, error=repr(error)))
 
     def unsubscribe(self, topic: str, handler: Callable[[Any], Coroutine]) -> None:
         """Unsubscribe a handler from a given topic."""
         if topic in self.channels:
-            self.channels[topic].listeners = [h for h in self.channels[topic].listeners if h != handler]
+            self.channels[topic].listeners = [sub for sub in self.channels[topic].listeners if sub.handler != handler]
 
             if not self.channels[topic].listeners:  # Remove topic if no subscribers remain
-                del self.channels[topic]
+                consumer = self.channels.pop(topic).consumer
+                self.transport.unsubscribe(topic)
+                for gauge in (QUEUE_DEPTH, IN_FLIGHT, OLDEST_RUNNING):
+                    gauge.remove(topic)
+                if consumer:
+                    self.loop.call_soon_threadsafe(consumer.cancel)
                 logger.info(f"[PubSub/unsubscribe] Topic '{topic}' removed due to no listeners")
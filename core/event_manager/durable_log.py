@@ -0,0 +1,168 @@
+import mmap
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from config import logger
+
+# record = header + payload, crc lets us find a record torn by a crash
+RECORD_HEADER = struct.Struct('!II')  # payload length, crc32 of payload
+COMMITTED = struct.Struct('!q')  # offset of the last message every listener finished with
+SEGMENT_SUFFIX = '.log'
+COMMIT_FILE = 'committed'
+
+
+class Segment:
+    """Preallocated memory-mapped file holding records with offsets base_offset, base_offset + 1, ..."""
+
+    def __init__(self, path: Path, base_offset: int, size: int):
+        self.path = path
+        self.base_offset = base_offset
+        exists = path.exists()
+        self._file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self._file.truncate(size)
+        self.size = os.fstat(self._file.fileno()).st_size
+        self.mm = mmap.mmap(self._file.fileno(), self.size)
+        self.position, self.count = self._recover() if exists else (0, 0)
+        self._flushed = self.position
+
+    @property
+    def next_offset(self) -> int:
+        return self.base_offset + self.count
+
+    def append(self, payload: bytes) -> bool:
+        """False when the record doesn't fit, the caller has to rotate"""
+        end = self.position + RECORD_HEADER.size + len(payload)
+        if end > self.size:
+            return False
+        RECORD_HEADER.pack_into(self.mm, self.position, len(payload), zlib.crc32(payload))
+        self.mm[self.position + RECORD_HEADER.size:end] = payload
+        self.position = end
+        self.count += 1
+        return True
+
+    def records(self, from_offset: int) -> Iterator[Tuple[int, bytes]]:
+        position, offset = 0, self.base_offset
+        while offset < self.next_offset:
+            length, _ = RECORD_HEADER.unpack_from(self.mm, position)
+            start = position + RECORD_HEADER.size
+            if offset >= from_offset:
+                yield offset, bytes(self.mm[start:start + length])
+            position, offset = start + length, offset + 1
+
+    def flush(self) -> None:
+        if self._flushed == self.position:
+            return
+        # msync wants a page aligned start
+        start = self._flushed - self._flushed % mmap.PAGESIZE
+        self.mm.flush(start, self.position - start)
+        self._flushed = self.position
+
+    def close(self) -> None:
+        self.flush()
+        self.mm.close()
+        self._file.close()
+
+    def _recover(self) -> Tuple[int, int]:
+        """Finds the end of the written records, a record torn by a crash is wiped"""
+        position, count = 0, 0
+        while position + RECORD_HEADER.size <= self.size:
+            length, crc = RECORD_HEADER.unpack_from(self.mm, position)
+            end = position + RECORD_HEADER.size + length
+            if length == 0:
+                break
+            if end > self.size or zlib.crc32(self.mm[position + RECORD_HEADER.size:end]) != crc:
+                logger.warning(f"[Segment/_recover] Torn record at {position} in {self.path}, dropping it")
+                wipe_end = min(end, self.size)
+                self.mm[position:wipe_end] = bytes(wipe_end - position)
+                break
+            position, count = end, count + 1
+        return position, count
+
+
+class DurableLog:
+    """
+    Append-only log of a single topic, split into memory-mapped segments of segment_size bytes.
+    append only copies the record into the mapped file, flush writes everything appended since the last flush
+    to disk at once(group commit). Consumers commit the offset they are done with, on restart everything after it
+    is replayed. Segments with only committed records are deleted.
+    """
+
+    def __init__(self, directory: Path, segment_size: int = 16 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.segment_size = segment_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.segments: List[Segment] = [
+            Segment(path, int(path.stem), segment_size)
+            for path in sorted(self.directory.glob(f'*{SEGMENT_SUFFIX}'))
+        ]
+        self._commit_fd = os.open(self.directory / COMMIT_FILE, os.O_RDWR | os.O_CREAT)
+        self.committed: int = self._read_committed()
+        self._committed_on_disk: int = self.committed
+        if not self.segments:
+            self.segments.append(self._new_segment(self.committed + 1))
+        logger.info(f"[DurableLog/__init__] {self.directory}: {self.next_offset - self.committed - 1} "
+                    f"messages to replay")
+
+    @property
+    def next_offset(self) -> int:
+        return self.segments[-1].next_offset
+
+    def append(self, payload: bytes) -> Optional[int]:
+        """Returns offset of the record, None if it can never fit in a segment"""
+        if RECORD_HEADER.size + len(payload) > self.segment_size:
+            logger.error(f"[DurableLog/append] Record of {len(payload)} bytes is bigger than a segment, not saved")
+            return None
+        offset = self.next_offset
+        if not self.segments[-1].append(payload):
+            self.segments[-1].flush()
+            self.segments.append(self._new_segment(offset))
+            self.segments[-1].append(payload)
+        return offset
+
+    def replay(self) -> Iterator[Tuple[int, bytes]]:
+        """Records which were appended but never committed"""
+        for segment in self.segments:
+            if segment.next_offset > self.committed + 1:
+                yield from segment.records(self.committed + 1)
+
+    def commit(self, offset: int) -> None:
+        """Everything up to offset is processed. Written to disk on the next flush."""
+        self.committed = max(self.committed, offset)
+
+    def flush(self) -> None:
+        for segment in self.segments:
+            segment.flush()
+        if self.committed != self._committed_on_disk:
+            os.pwrite(self._commit_fd, COMMITTED.pack(self.committed), 0)
+            os.fsync(self._commit_fd)
+            self._committed_on_disk = self.committed
+            self._delete_committed_segments()
+
+    def close(self) -> None:
+        self.flush()
+        for segment in self.segments:
+            segment.close()
+        os.close(self._commit_fd)
+
+    def _new_segment(self, base_offset: int) -> Segment:
+        return Segment(self.directory / f'{base_offset:020d}{SEGMENT_SUFFIX}', base_offset, self.segment_size)
+
+    def _read_committed(self) -> int:
+        data = os.pread(self._commit_fd, COMMITTED.size, 0)
+        if len(data) < COMMITTED.size:
+            # fresh log, or log whose commit file got lost. Start from the oldest record we still have
+            return self.segments[0].base_offset - 1 if self.segments else -1
+        return COMMITTED.unpack(data)[0]
+
+    def _delete_committed_segments(self) -> None:
+        # the last segment is still written to, so it always stays
+        while len(self.segments) > 1 and self.segments[0].next_offset <= self.committed + 1:
+            segment = self.segments.pop(0)
+            segment.close()
+            segment.path.unlink(missing_ok=True)
+            logger.debug(f"[DurableLog/_delete_committed_segments] Deleted {segment.path}")
@@ -0,0 +1,350 @@
+import asyncio
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from dataclasses import replace, is_dataclass
+from typing import Any, Dict, List, Optional, Tuple, Hashable
+
+from utils import Message
+from config import logger
+
+# frame = header + topic + payload, payload of a published message is a pickled Message
+# routing key is a hash of the chat of the message, 0 - none. The broker routes by it without unpickling the payload
+FRAME_HEADER = struct.Struct('!BHII')  # kind, topic length, payload length, routing key
+SUBSCRIBE, UNSUBSCRIBE, PUBLISH, DELIVER = 1, 2, 3, 4
+
+
+def default_socket_path() -> str:
+    """Socket in a directory of its own, under $XDG_RUNTIME_DIR if there is one"""
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(base, f'raise_pubsub-{os.getuid()}', 'pubsub.sock')
+
+
+def ensure_private_dir(path: str) -> None:
+    """
+    Payloads are pickles, whoever can connect to the socket(or put his own in its place) can run code in our
+    processes. So its directory has to belong to this user and be closed to everyone else.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{directory} has to belong to this user and be accessible only by them(0700)")
+
+
+def encode_frame(kind: int, topic: str, payload: bytes = b'', key: int = 0) -> bytes:
+    topic_bytes = topic.encode('utf-8')
+    return FRAME_HEADER.pack(kind, len(topic_bytes), len(payload), key) + topic_bytes + payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[int, str, bytes, int]:
+    kind, topic_length, payload_length, key = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    body = await reader.readexactly(topic_length + payload_length)
+    return kind, body[:topic_length].decode('utf-8'), body[topic_length:], key
+
+
+def routing_key(message: Any) -> int:
+    """Same for every message of a chat in every process, 0 for messages without a chat"""
+    session_key = getattr(message, 'session_key', None)
+    if session_key is None or session_key[1] is None:
+        return 0
+    return zlib.crc32(repr(session_key).encode('utf-8')) or 1
+
+
+def strip_local_fields(message: Message, **changes) -> Message:
+    """Copy of the message without fields which can't leave the process, chat id is kept for session_key"""
+    stripped = {name: None for name in message.local_fields}
+    return replace(message, chat_id=message.session_key[1], **stripped, **changes)
+
+
+class LocalStash:
+    """
+    Keeps local fields of messages which were sent to other processes, until their final reply comes back.
+    Oldest entries are forgotten once there are more than max_size, so replies which never come don't leak memory.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self.prefix = f'{os.getpid()}-{uuid.uuid4().hex[:8]}-'  # refs made by this stash
+        self._entries: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def strip(self, message: Any) -> Any:
+        """Returns a copy of the message which can be pickled"""
+        if is_dataclass(message) and isinstance(getattr(message, 'message', None), Message):
+            return replace(message, message=self.strip(message.message))  # e.g. ListenerError
+        if not isinstance(message, Message):
+            return message
+
+        local = {name: getattr(message, name) for name in message.local_fields}
+        if not any(value is not None for value in local.values()):
+            return message
+
+        ref = message.local_ref or f'{self.prefix}{uuid.uuid4().hex}'
+        with self._lock:
+            self._entries[ref] = local
+            self._entries.move_to_end(ref)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return strip_local_fields(message, local_ref=ref)
+
+    def restore(self, message: Any) -> Any:
+        """Puts local fields back if the message started in this process"""
+        if not isinstance(message, Message) or not message.local_ref or not message.local_ref.startswith(self.prefix):
+            return message
+        # only the final reply is the last time these fields are needed, partial replies come before it
+        is_final_reply = message.response_message is not None and not message.is_partial
+        with self._lock:
+            if is_final_reply:
+                local = self._entries.pop(message.local_ref, None)
+            else:
+                local = self._entries.get(message.local_ref)
+        if local is None:
+            logger.warning(f"[LocalStash/restore] Local fields of {message.local_ref} were already forgotten")
+            return message
+        for name, value in local.items():
+            setattr(message, name, value)
+        return message
+
+
+class Transport:
+    """
+    Moves messages between PubSub instances. The default one does nothing, everything stays in one process.
+    Remote transports get every publish and hand messages from other processes to PubSub._deliver on its loop.
+    """
+    is_remote: bool = False
+
+    def __init__(self):
+        self.pubsub: Optional['PubSub'] = None
+
+    def attach(self, pubsub: 'PubSub') -> None:
+        self.pubsub = pubsub
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    def subscribe(self, topic: str, group: Optional[str] = None) -> None:
+        pass
+
+    def unsubscribe(self, topic: str) -> None:
+        pass
+
+    def publish(self, topic: str, message: Any) -> None:
+        raise NotImplementedError
+
+
+class LocalTransport(Transport):
+    pass
+
+
+class SocketTransport(Transport):
+    """
+    Client of SocketBroker, talks to it over a unix domain socket.
+    Every publish goes through the broker, even when a listener of the topic lives in this process.
+    Local fields of messages are stripped before pickling and put back when the reply returns.
+    """
+    is_remote = True
+
+    def __init__(self, path: Optional[str] = None, reconnect_delay: float = 1.0):
+        super().__init__()
+        self.path = path or default_socket_path()
+        self.reconnect_delay = reconnect_delay
+        self.stash = LocalStash()
+        # topic -> queue group
+        self.subscriptions: Dict[str, Optional[str]] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connection: Optional[asyncio.Task] = None
+        self._loop_thread: Optional[int] = None
+        # published before the connection was made, sent right after connecting
+        self._backlog: List[bytes] = []
+
+    async def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._connection = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._connection:
+            self._connection.cancel()
+            await asyncio.gather(self._connection, return_exceptions=True)
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    def subscribe(self, topic: str, group: Optional[str] = None) -> None:
+        self.subscriptions[topic] = group
+        self._send(encode_frame(SUBSCRIBE, topic, (group or '').encode('utf-8')), keep=False)
+
+    def unsubscribe(self, topic: str) -> None:
+        self.subscriptions.pop(topic, None)
+        self._send(encode_frame(UNSUBSCRIBE, topic), keep=False)
+
+    def publish(self, topic: str, message: Any) -> None:
+        # pickled in the publishing thread, pubsub loop only writes bytes
+        try:
+            payload = pickle.dumps(self.stash.strip(message), protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.error(f"[SocketTransport/publish] Couldn't serialize message for {topic} topic: {e}")
+            return
+        self._send(encode_frame(PUBLISH, topic, payload, routing_key(message)))
+
+    def _send(self, frame: bytes, keep: bool = True) -> None:
+        if threading.get_ident() == self._loop_thread:
+            self._write(frame, keep)
+            return
+        try:
+            self.pubsub.loop.call_soon_threadsafe(self._write, frame, keep)
+        except RuntimeError:
+            logger.warning(f"[SocketTransport/_send] PubSub loop is closed, message is lost")
+
+    def _write(self, frame: bytes, keep: bool) -> None:
+        if self._writer is None or self._writer.is_closing():
+            if keep:
+                self._backlog.append(frame)
+            return
+        self._writer.write(frame)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                ensure_private_dir(self.path)
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError as e:
+                logger.warning(f"[SocketTransport/_run] Broker at {self.path} is unreachable: {e}")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+
+            logger.info(f"[SocketTransport/_run] Connected to broker at {self.path}")
+            for topic, group in self.subscriptions.items():
+                writer.write(encode_frame(SUBSCRIBE, topic, (group or '').encode('utf-8')))
+            backlog, self._backlog = self._backlog, []
+            writer.writelines(backlog)
+            self._writer = writer
+            try:
+                await self._read(reader)
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                logger.warning(f"[SocketTransport/_run] Lost connection to broker: {e!r}")
+            finally:
+                self._writer = None
+                writer.close()
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _read(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            kind, topic, payload, _ = await read_frame(reader)
+            if kind != DELIVER:
+                continue
+            try:
+                message = pickle.loads(payload)
+            except Exception as e:
+                logger.error(f"[SocketTransport/_read] Couldn't deserialize message from {topic} topic: {e}")
+                continue
+            # never waits, a full topic doesn't hold up messages of the others
+            self.pubsub._deliver(topic, self.stash.restore(message))
+
+
+class SocketBroker:
+    """
+    Routes messages between processes connected with SocketTransport.
+    Clients subscribed to a topic with the same queue group share its messages, so several brain workers can
+    consume one topic. Messages of one chat always go to the same member(by the routing key), so its history and
+    the order of its messages stay in one process. Messages without a chat are shared round-robin.
+    A client without a group gets every message of the topic.
+    Payloads are forwarded as they are, the broker never unpickles them.
+    Only processes of the same user can connect, see ensure_private_dir.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or default_socket_path()
+        # topic -> group -> members, clients without a group are a group of their own
+        self.groups: Dict[str, Dict[Hashable, List[asyncio.StreamWriter]]] = {}
+        self._turns: Dict[Tuple[str, Hashable], int] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        ensure_private_dir(self.path)
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left from a previous run
+        self._server = await asyncio.start_unix_server(self._handle_client, path=self.path)
+        os.chmod(self.path, 0o600)
+        logger.info(f"[SocketBroker/start] Listening on {self.path}")
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        logger.info(f"[SocketBroker/_handle_client] Client connected")
+        try:
+            while True:
+                kind, topic, payload, key = await read_frame(reader)
+                if kind == PUBLISH:
+                    await self._route(topic, payload, key)
+                elif kind == SUBSCRIBE:
+                    self._subscribe(topic, payload.decode('utf-8') or None, writer)
+                elif kind == UNSUBSCRIBE:
+                    self._remove(writer, topic)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info(f"[SocketBroker/_handle_client] Client disconnected")
+        finally:
+            self._remove(writer)
+            writer.close()
+
+    def _subscribe(self, topic: str, group: Optional[str], writer: asyncio.StreamWriter) -> None:
+        key = group if group is not None else id(writer)
+        members = self.groups.setdefault(topic, {}).setdefault(key, [])
+        if writer not in members:
+            members.append(writer)
+            logger.info(f"[SocketBroker/_subscribe] Client subscribed to {topic}, group: {group}")
+
+    def _remove(self, writer: asyncio.StreamWriter, topic: Optional[str] = None) -> None:
+        topics = [topic] if topic else list(self.groups)
+        for name in topics:
+            groups = self.groups.get(name, {})
+            for key, members in list(groups.items()):
+                if writer in members:
+                    members.remove(writer)
+                if not members:
+                    del groups[key]
+                    self._turns.pop((name, key), None)
+            if not groups:
+                self.groups.pop(name, None)
+
+    async def _route(self, topic: str, payload: bytes, key: int = 0) -> None:
+        groups = self.groups.get(topic)
+        if not groups:
+            logger.debug(f"[SocketBroker/_route] No one listens to {topic} topic. Ignoring")
+            return
+
+        frame = encode_frame(DELIVER, topic, payload)
+        receivers = []
+        for group, members in groups.items():
+            if key:
+                receivers.append(members[key % len(members)])
+                continue
+            turn = self._turns.get((topic, group), 0)
+            self._turns[(topic, group)] = turn + 1
+            receivers.append(members[turn % len(members)])
+
+        for writer in receivers:
+            writer.write(frame)
+        for writer in receivers:
+            try:
+                await writer.drain()  # slow clients slow down publishers instead of growing broker memory
+            except ConnectionError:
+                self._remove(writer)
@@ -9,6 +9,8 @@ class Memory(BaseModel):
     from_name: str
     message: str
     time: datetime
+    # chat the memory comes from, e.g. 'telegram:123'. Chat history is fetched per session
+    session: Optional[str] = None
 
     # metrics for similarity search
     distance: Optional[float] = None
@@ -19,6 +21,10 @@ class Memory(BaseModel):
 class MemoryChain(BaseModel):
     memories: Optional[List[Memory]] = Field(default_factory=list)
 
+    @property
+    def session(self) -> Optional[str]:
+        return self.memories[0].session if self.memories else None
+
     def add_object(self,
                    from_name: Optional[str] = None,
                    message: Optional[str] = None,
@@ -27,6 +33,7 @@ class MemoryChain(BaseModel):
                    certainty: Optional[float] = None,
                    score: Optional[float] = None,
                    *,
+                   session: Optional[str] = None,
                    memory: Optional[Memory] = None):
 
         if memory:
@@ -40,6 +47,7 @@ class MemoryChain(BaseModel):
             from_name=from_name,
             message=message,
             time=time,
+            session=session,
             distance=distance,
             certainty=certainty,
             score=score
@@ -53,7 +61,8 @@ class Async_DB_Interface(ABC):
         pass
 
     @abstractmethod
-    async def add_memories(self, memory_chain: MemoryChain) -> bool:
+    async def add_memories(self, memory_chain: MemoryChain) -> Optional[int]:
+        """Returns version of stored memories right after this write(see get_memory_version), None if it failed"""
         pass
 
     @abstractmethod
@@ -66,5 +75,17 @@ class Async_DB_Interface(ABC):
         pass
 
     @abstractmethod
-    async def get_chat_memory(self) -> Optional[MemoryChain]:
+    async def get_chat_memory(self, limit: int = 20, session: Optional[str] = None) -> Optional[MemoryChain]:
+        """last limit memories of the session in chat order, of all sessions if session is None"""
         pass
+
+    async def get_memory_version(self, session: Optional[str] = None) -> Optional[int]:
+        """
+        Cheap way to check if stored memories of a session changed since the last look.
+        Version grows by one for every memory added to the session and for every deleted memory,
+        writes of other sessions don't change it. None means that versioning is not supported and caller should refetch.
+        """
+        return None
+
+
+from .write_behind import WriteBehindMemory
@@ -1,16 +1,19 @@
 import asyncio
-from typing import Optional
+import random
+from typing import Dict, Optional
 
 from . import WeaviateSettings, logger, MemoryChain, WeaviateBase, WeaviateAsyncClient
 from .weaviate_utils import (bm_25_search,
                              near_text_search,
                              hybrid_search,
                              convert_response_to_mem_chain,
+                             migrate_sessions,
                              )
 
-from weaviate.classes.query import Sort
+from weaviate.classes.query import Filter, Sort
 from weaviate.connect import ConnectionParams
 from weaviate.exceptions import UnexpectedStatusCodeError
+from weaviate.util import generate_uuid5
 
 
 similarity_search = {
@@ -24,6 +27,13 @@ similarity_search = {
 class Weaviate(WeaviateBase):
     def __init__(self, settings: 'WeaviateSettings'):
         super().__init__(settings)
+        # Versions let clients skip refetching chat history. They start at a random value,
+        # so a version seen before a restart doesn't match the new one by accident
+        self._epoch: int = random.getrandbits(48)
+        self.memory_version: int = self._epoch  # bumped by every added/deleted memory
+        # memories added to each session since the start, writes of one chat don't outdate history of the others
+        self._session_added: Dict[str, int] = {}
+        self._deleted: int = 0
 
     async def is_alive(self) -> bool:
         if self.client and await self.client.is_live():
@@ -31,29 +41,38 @@ class Weaviate(WeaviateBase):
         logger.info(f"[Weaviate/is_alive] Connection is closed.")
         return False
 
-    async def add_memories(self, memory_chain: MemoryChain) -> bool:
+    async def add_memories(self, memory_chain: MemoryChain) -> Optional[int]:
         logger.info(f"[Weaviate/add_memories] Starting to add memories {memory_chain}")
 
         if not await self.is_alive():
             logger.error(f"[Weaviate/add_memories] Connection is closed. Cannot add memories")
-            return False
+            return None
 
         collection = self.client.collections.get(self.config.class_name)
 
-        try:
-            for memory in memory_chain.memories:
-                uuid = await collection.data.insert({
+        for memory in memory_chain.memories:
+            # the same memory always gets the same uuid, so a chain can be added again after a failure
+            uuid = generate_uuid5(f"{memory.session}|{memory.from_name}|{memory.time.isoformat()}|{memory.message}")
+            try:
+                await collection.data.insert({
                     "from": memory.from_name,
                     "message": memory.message,
-                    "datetime": memory.time
-                })
-                logger.info(f"[Weaviate/add_memories] Memory added successfully {uuid}")
-        except UnexpectedStatusCodeError as e:
-            logger.error(f"[Weaviate/add_memories] Couldn't add data, most likely because there is memory in db with same parameters {e}")
-            return False
-        else:
-            logger.info(f"[Weaviate/add_memories] Memory chain added successfully")
-            return True
+                    "datetime": memory.time,
+                    "session": memory.session
+                }, uuid=uuid)
+            except UnexpectedStatusCodeError as e:
+                if await collection.data.exists(uuid):
+                    logger.info(f"[Weaviate/add_memories] Memory {uuid} is already saved, skipping it")
+                    continue
+                logger.error(f"[Weaviate/add_memories] Couldn't add data {e}")
+                return None
+            self.memory_version += 1
+            if memory.session is not None:
+                self._session_added[memory.session] = self._session_added.get(memory.session, 0) + 1
+            logger.info(f"[Weaviate/add_memories] Memory added successfully {uuid}")
+
+        logger.info(f"[Weaviate/add_memories] Memory chain added successfully")
+        return self.version_of(memory_chain.session)
 
     async def get_context(self, query: str) -> Optional[MemoryChain]:
         logger.info(f"[Weaviate/get_chat_memory] getting context(sim_search) for {query}")
@@ -72,16 +91,17 @@ class Weaviate(WeaviateBase):
         logger.info(f"[Weaviate/get_chat_memory] Successfully got context for query {query}")
         return memory_chain
 
-    async def get_chat_memory(self, limit_messages=20) -> Optional[MemoryChain]:
+    async def get_chat_memory(self, limit_messages=20, session: Optional[str] = None) -> Optional[MemoryChain]:
         if not await self.is_alive():
             logger.error(f"[Weaviate/get_chat_memory] Connection is closed. Cannot get chat memory")
             return None
 
         # returns last n messages, n counts for both the user and an AI
-        logger.info(f"[Weaviate/get_chat_memory] getting chat history for {limit_messages} messages")
+        logger.info(f"[Weaviate/get_chat_memory] getting chat history of {session} for {limit_messages} messages")
         try:
             collection = self.client.collections.get(self.config.class_name)
             response = await collection.query.fetch_objects(
+                filters=Filter.by_property("session").equal(session) if session is not None else None,
                 sort=Sort.by_property(name="datetime", ascending=False),
                 limit=limit_messages,
             )
@@ -94,6 +114,15 @@ class Weaviate(WeaviateBase):
         logger.info(f"[Weaviate/get_chat_memory] Successfully retrieved chat history for {limit_messages} messages")
         return mem_chain
 
+    async def get_memory_version(self, session: Optional[str] = None) -> Optional[int]:
+        return self.version_of(session)
+
+    def version_of(self, session: Optional[str]) -> int:
+        if session is None:
+            return self.memory_version
+        # we don't know the session of a deleted memory, so deletes count for every session
+        return self._epoch + self._deleted + self._session_added.get(session, 0)
+
     async def close(self) -> None:
         if self.client and await self.client.is_live():
             await self.client.close()
@@ -125,6 +154,7 @@ class Weaviate(WeaviateBase):
                 self.client = WeaviateAsyncClient(connection_params=conn_params)
                 await self.client.connect()
                 logger.info(f"[Weaviate/connect_db] Successfully connected to Async version of Weaviate")
+                await self._migrate()
                 return True
             except Exception as e:  # should fix this later proly
                 if self.client:
@@ -138,6 +168,14 @@ class Weaviate(WeaviateBase):
         # raise weaviate.WeaviateStartUpError(final_err_str)
         return False
 
+    async def _migrate(self) -> None:
+        """Brings collections made by older versions up to date, see migrate_sessions"""
+        try:
+            if await self.client.collections.exists(self.config.class_name):
+                await migrate_sessions(self, self.config.legacy_session)
+        except Exception as e:
+            logger.error(f"[Weaviate/_migrate] Couldn't migrate {self.config.class_name}: {e}")
+
     async def delete_by_uuid(self, uuid: str):
         logger.info(f'[Weaviate/delete_by_uuid] {uuid}')
         assert isinstance(uuid, str) and uuid is not None, "Faulty value of uuid"
@@ -146,6 +184,8 @@ class Weaviate(WeaviateBase):
             await collection.data.delete_by_id(
                 uuid
             )
+            self.memory_version += 1
+            self._deleted += 1
             return True
         except Exception as e:
             logger.error(f'[Weaviate/delete_by_uuid] {e}')
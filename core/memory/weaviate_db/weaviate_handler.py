@@ -23,7 +23,7 @@ class WeaviateHelper(Async_DB_Interface):
         self.base_url = base_url
         self.client = AsyncClient()
 
-    async def add_memories(self, memory_chain: MemoryChain) -> bool:
+    async def add_memories(self, memory_chain: MemoryChain) -> Optional[int]:
         url = f"{self.base_url}/add_memories"
         try:
 
@@ -32,12 +32,12 @@ class WeaviateHelper(Async_DB_Interface):
             response = await self.client.post(url, json={"memory_chain": memory_chain_json})
             if response.status_code == 200:
                 logger.info(f'[WeaviateHelper/add_memories] Memories were added successfully')
-                return True
+                return response.json().get("version")
             logger.error(f"[WeaviateHelper/add_memories] Failed to add memories with status {response.status_code}: {response.text}")
-            return False
+            return None
         except Exception as e:
             logger.error(f"[WeaviateHelper/add_memories] Exception: {e}")
-            return False
+            return None
 
     async def get_context(self, query: str) -> Optional[MemoryChain]:
         url = f"{self.base_url}/get_context"
@@ -55,11 +55,12 @@ class WeaviateHelper(Async_DB_Interface):
             logger.error(f"[WeaviateHelper/get_context] Exception: {e}")
             return None
 
-    async def get_chat_memory(self, limit: int = 20) -> Optional[MemoryChain]:
+    async def get_chat_memory(self, limit: int = 20, session: Optional[str] = None) -> Optional[MemoryChain]:
         url = f"{self.base_url}/get_chat_memory"
+        params = {"limit": limit} if session is None else {"limit": limit, "session": session}
         try:
-            logger.info(f"[WeaviateHelper/get_chat_memory] Sending get request for chat memory with limit: {limit}")
-            response = await self.client.get(url, params={"limit": limit})
+            logger.info(f"[WeaviateHelper/get_chat_memory] Sending get request for chat memory of {session} with limit: {limit}")
+            response = await self.client.get(url, params=params)
             if response.status_code == 200:
                 logger.info(
                     f"[WeaviateHelper/get_chat_memory] Successfully retrieved chat memories with")
@@ -71,6 +72,20 @@ class WeaviateHelper(Async_DB_Interface):
             logger.error(f"[WeaviateHelper/get_chat_memory] Exception: {e}")
             return None
 
+    async def get_memory_version(self, session: Optional[str] = None) -> Optional[int]:
+        url = f"{self.base_url}/memory_version"
+        try:
+            response = await self.client.get(url, params={} if session is None else {"session": session})
+            if response.status_code == 200:
+                version = response.json().get("version")
+                logger.debug(f"[WeaviateHelper/get_memory_version] Memory version is {version}")
+                return version
+            logger.error(f"[WeaviateHelper/get_memory_version] Failed to get memory version with status {response.status_code}: {response.text}")
+            return None
+        except Exception as e:
+            logger.error(f"[WeaviateHelper/get_memory_version] Exception: {e}")
+            return None
+
     async def _shutdown_server(self) -> bool:
         url = f"{self.base_url}/shutdown"
 
@@ -107,6 +122,7 @@ def convert_memory_chain_to_json(memory_chain: MemoryChain) -> List[dict]:
                 "from_name": memory.from_name,
                 "message": memory.message,
                 "time": memory.time.isoformat(),  # Convert datetime to string for JSON
+                "session": memory.session,
                 "distance": memory.distance,
                 "certainty": memory.certainty,
                 "score": memory.score,
@@ -128,6 +144,7 @@ def convert_json_to_memory_chain(json_data: List[dict]) -> MemoryChain:
                 from_name=memory_data["from_name"],
                 message=memory_data["message"],
                 time=datetime.datetime.fromisoformat(memory_data["time"]),
+                session=memory_data.get("session"),
                 distance=memory_data.get("distance"),
                 certainty=memory_data.get("certainty"),
                 score=memory_data.get("score"),
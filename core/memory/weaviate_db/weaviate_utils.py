@@ -4,7 +4,7 @@ import json
 import os.path
 from typing import Optional
 
-from weaviate.classes.config import Configure, Property, DataType
+from weaviate.classes.config import Configure, Property, DataType, Tokenization
 from weaviate.classes.query import MetadataQuery, Filter, Sort
 from weaviate import exceptions
 
@@ -12,6 +12,11 @@ from . import WeaviateBase, Memory, MemoryChain, BACKUP_DIR, logger
 from concurrent.futures import ThreadPoolExecutor
 
 
+# chat the message comes from, matched exactly when chat history is fetched
+SESSION_PROPERTY = Property(name="session", data_type=DataType.TEXT, skip_vectorization=True,
+                            tokenization=Tokenization.FIELD)
+
+
 # all backups would be stored at base/asses/db_backups
 # TODO MAKE ASYNC WRITING OF BACKUP TO FILE LATER ON
 async def backup(weaviate_db: WeaviateBase):
@@ -68,7 +73,8 @@ async def load_from_backup(weaviate_db: WeaviateBase, file_name):
             uuid = await collection.data.insert({
                 "from": from_field,
                 "message": message_field,
-                "datetime": datetime_field
+                "datetime": datetime_field,
+                "session": message_data.get('session')
             })
         except exceptions.ObjectAlreadyExistsException:
             logger.error(
@@ -109,6 +115,7 @@ async def retrieve_all_objects(weaviate_db: WeaviateBase, limit=50):
                     "from": o.properties["from"],
                     "message": o.properties["message"],
                     "datetime": o.properties["datetime"].isoformat(),
+                    "session": o.properties.get("session"),
                 }
                 all_objects[str(o.uuid)] = data
                 logger.info(f"[Weaviate_utils/retrieve_all_objects] adding object uuid({str(o.uuid)}) {data}")
@@ -136,12 +143,13 @@ def convert_response_to_mem_chain(response, algo_name: Optional[str] = None) ->
             from_name = o.properties["from"]
             message = o.properties["message"]
             time = o.properties["datetime"]
+            session = o.properties.get("session")
             distance = o.metadata.distance
             certainty = o.metadata.certainty
             score = o.metadata.score
 
-            memory = Memory(from_name=from_name, message=message, time=time, distance=distance, certainty=certainty,
-                            score=score)
+            memory = Memory(from_name=from_name, message=message, time=time, session=session, distance=distance,
+                            certainty=certainty, score=score)
             # sim_search.add_object(from_name=from_name,message=message,time=time,distance=distance,certainty=certainty,score=score)
             sim_search.add_object(memory=memory)
     except Exception as e:
@@ -244,8 +252,49 @@ async def create_collection(weaviate_db: WeaviateBase, collection_name: str):
         properties=[
             Property(name="from", data_type=DataType.TEXT, skip_vectorization=True),
             Property(name="message", data_type=DataType.TEXT),
-            Property(name="datetime", data_type=DataType.DATE, skip_vectorization=True)
+            Property(name="datetime", data_type=DataType.DATE, skip_vectorization=True),
+            SESSION_PROPERTY
         ],
     )
 
     return await new_collection_scheme.config.get()
+
+
+async def migrate_sessions(weaviate_db: WeaviateBase, legacy_session: Optional[str], limit=50) -> int:
+    """
+    Collections created before chats had their own history don't have the session property, it is added here.
+    Memories saved before that have no session, so no chat history would show them. They are moved to
+    legacy_session if it is set. Returns the number of memories still without a session.
+    """
+    collection = weaviate_db.client.collections.get(weaviate_db.config.class_name)
+    config = await collection.config.get()
+    if not any(prop.name == SESSION_PROPERTY.name for prop in config.properties):
+        logger.info(f"[Weaviate_utils/migrate_sessions] Adding session property to {weaviate_db.config.class_name}")
+        await collection.config.add_property(SESSION_PROPERTY)
+
+    offset = 0
+    moved, left = 0, 0
+    while True:
+        response = await collection.query.fetch_objects(
+            sort=Sort.by_property(name="datetime", ascending=True),
+            limit=limit,
+            offset=offset
+        )
+        for o in response.objects:
+            if o.properties.get("session"):
+                continue
+            if legacy_session is None:
+                left += 1
+                continue
+            await collection.data.update(uuid=o.uuid, properties={"session": legacy_session})
+            moved += 1
+        offset += limit
+        if len(response.objects) < limit:
+            break
+
+    if moved:
+        logger.info(f"[Weaviate_utils/migrate_sessions] Moved {moved} memories without a session to {legacy_session}")
+    if left:
+        logger.warning(f"[Weaviate_utils/migrate_sessions] {left} memories have no session and won't be in any "
+                       f"chat history, set weaviate.legacy_session to move them to a chat")
+    return left
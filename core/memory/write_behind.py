@@ -0,0 +1,240 @@
+import asyncio
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from config import logger, BACKUP_DIR
+from . import Async_DB_Interface, Memory, MemoryChain
+
+SPILL_FILE = BACKUP_DIR / "pending_memories.jsonl"
+
+
+class WriteBehindMemory(Async_DB_Interface):
+    """
+    Wraps another db interface. add_memories only queues memory chains, a background task writes them in batches
+    once batch_size chains are waiting or every flush_interval seconds, retrying with exponential backoff.
+    Chains which still couldn't be written are appended to a local file and replayed once the db is reachable again.
+    Backend writes have to be idempotent, a batch which failed halfway is written again as a whole.
+    Queued chains are visible in get_chat_memory of their session before they reach the db.
+    """
+
+    def __init__(self,
+                 backend: Async_DB_Interface,
+                 batch_size: int = 8,
+                 flush_interval: float = 2.0,
+                 max_retries: int = 3,
+                 retry_delay: float = 1.0,
+                 spill_path: Path = SPILL_FILE):
+        self.backend: Async_DB_Interface = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.spill_path = Path(spill_path)
+
+        self.pending: List[MemoryChain] = []
+        self._in_flight: List[MemoryChain] = []
+        self._spilled: List[MemoryChain] = self._load_spilled()
+        # per session: version of the backend plus memories which weren't written yet, see get_memory_version
+        self._versions: Dict[Optional[str], int] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def connect(self) -> bool:
+        return await self.backend.connect()
+
+    async def add_memories(self, memory_chain: MemoryChain) -> Optional[int]:
+        session = memory_chain.session
+        if session not in self._versions:
+            # counted from 0 until the backend tells us its version
+            self._versions[session] = await self.backend.get_memory_version(session) or 0
+        self.pending.append(memory_chain)
+        self._versions[session] += len(memory_chain.memories)
+        self._ensure_worker()
+        logger.info(f"[WriteBehindMemory/add_memories] Queued memory chain, {len(self.pending)} waiting")
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+        return self._versions[session]
+
+    async def get_context(self, query) -> Optional[MemoryChain]:
+        return await self.backend.get_context(query)
+
+    async def get_chat_memory(self, limit: int = 20, session: Optional[str] = None) -> Optional[MemoryChain]:
+        if self._spilled:
+            self._ensure_worker()  # memories left from the previous run are replayed in the background
+        memory_chain = await self.backend.get_chat_memory(limit, session)
+        not_written = self._not_written_memories(session)
+        if not not_written:
+            return memory_chain
+        if memory_chain is None:
+            memory_chain = MemoryChain()
+        memory_chain.memories = (memory_chain.memories + not_written)[-limit:]
+        return memory_chain
+
+    async def get_memory_version(self, session: Optional[str] = None) -> Optional[int]:
+        """
+        Queued memories are counted as if they were written already.
+        So the version changes right when a chain is queued and doesn't change again when it is written.
+        """
+        version = await self.backend.get_memory_version(session)
+        if version is None:
+            return None
+        self._versions[session] = version + len(self._not_written_memories(session))
+        return self._versions[session]
+
+    async def drain(self) -> None:
+        """
+        Stops the writer and writes everything still queued. Has to be awaited on the loop the writer runs on
+        (the one add_memories was called from) while it is still running, brain does it when pubsub stops.
+        """
+        worker, self._worker = self._worker, None
+        if worker is not None and not worker.done():
+            if worker.get_loop() is not asyncio.get_running_loop():
+                # can't stop it from here, memories go to the local file. Writes are idempotent,
+                # so chains the worker still writes are just skipped when they are replayed
+                logger.error(f"[WriteBehindMemory/drain] Memory writer runs on another loop, queued memories are "
+                             f"saved to {self.spill_path} and written on the next start")
+                leftovers = self._in_flight + self.pending
+                self._in_flight, self.pending = [], []
+                if leftovers:
+                    self._spill(leftovers)
+                return
+            # worker mustn't write the same chains while we do
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+
+        leftovers = self._in_flight + self.pending
+        self._in_flight, self.pending = [], []
+        if leftovers:
+            _, failed = await self._write(leftovers)
+            if failed:
+                self._spill(failed)
+
+    async def close(self) -> None:
+        await self.drain()  # nothing left to do if brain drained it already
+        await self.backend.close()
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        logger.info(f"[WriteBehindMemory/_run] Starting memory writer")
+        while True:
+            try:
+                async with asyncio.timeout(self.flush_interval):
+                    await self._wakeup.wait()
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.error(f"[WriteBehindMemory/_run] Unexpected error while flushing memories: {e}")
+
+    async def _flush(self) -> None:
+        if self._spilled:
+            await self._replay_spilled()
+
+        if not self.pending:
+            return
+
+        self._in_flight, self.pending = self.pending, []
+        logger.info(f"[WriteBehindMemory/_flush] Writing {len(self._in_flight)} memory chains")
+        versions, failed = await self._write(self._in_flight)
+        if failed:
+            self._spill(failed)
+        self._in_flight = []
+        self._settle_versions(versions)
+
+    async def _write(self, chains: List[MemoryChain]) -> Tuple[Dict[Optional[str], int], List[MemoryChain]]:
+        """
+        Memories of every session are written as one batch, a failed batch doesn't stop the others.
+        Returns versions of the backend after the write per written session and chains which couldn't be written
+        """
+        by_session: Dict[Optional[str], List[MemoryChain]] = {}
+        for chain in chains:
+            by_session.setdefault(chain.session, []).append(chain)
+
+        versions, failed = {}, []
+        for session, session_chains in by_session.items():
+            batch = MemoryChain(memories=[memory for chain in session_chains for memory in chain.memories])
+            version = await self._write_batch(batch)
+            if version is None:
+                failed.extend(session_chains)
+            else:
+                versions[session] = version
+        return versions, failed
+
+    async def _write_batch(self, batch: MemoryChain) -> Optional[int]:
+        delay = self.retry_delay
+        for attempt in range(1, self.max_retries + 1):
+            version = await self.backend.add_memories(memory_chain=batch)
+            if version is not None:
+                return version
+            logger.warning(f"[WriteBehindMemory/_write_batch] Couldn't write memories, attempt {attempt}/{self.max_retries}")
+            if attempt < self.max_retries:
+                await asyncio.sleep(delay)
+                delay *= 2
+        return None
+
+    def _settle_versions(self, versions: Dict[Optional[str], int]) -> None:
+        """Backend version plus memories still waiting should match the version we handed out"""
+        for session, version in versions.items():
+            actual = version + len(self._not_written_memories(session))
+            expected = self._versions.get(session)
+            if expected is not None and expected != actual:
+                logger.info(f"[WriteBehindMemory/_settle_versions] Memories of {session} were changed elsewhere "
+                            f"({expected} -> {actual})")
+            self._versions[session] = actual
+
+    async def _replay_spilled(self) -> None:
+        if not await self.backend.connect():
+            logger.debug(f"[WriteBehindMemory/_replay_spilled] Db is still unreachable")
+            return
+
+        logger.info(f"[WriteBehindMemory/_replay_spilled] Replaying {len(self._spilled)} memory chains from {self.spill_path}")
+        versions, failed = await self._write(self._spilled)
+        if versions:
+            # file is rewritten with only the chains which still failed
+            self._spilled = []
+            self.spill_path.unlink(missing_ok=True)
+            if failed:
+                self._spill(failed)
+            self._settle_versions(versions)
+        if failed:
+            return
+        logger.info(f"[WriteBehindMemory/_replay_spilled] Replayed memories successfully")
+
+    def _spill(self, chains: List[MemoryChain]) -> None:
+        logger.error(f"[WriteBehindMemory/_spill] Db is unreachable, saving {len(chains)} memory chains to {self.spill_path}")
+        try:
+            with open(self.spill_path, 'a', encoding='utf-8') as file:
+                for chain in chains:
+                    file.write(chain.model_dump_json() + '\n')
+        except IOError as e:
+            logger.error(f"[WriteBehindMemory/_spill] Couldn't save memories to {self.spill_path}, they are lost: {e}")
+            return
+        self._spilled.extend(chains)
+
+    def _load_spilled(self) -> List[MemoryChain]:
+        if not self.spill_path.exists():
+            return []
+
+        chains = []
+        with open(self.spill_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    chains.append(MemoryChain.model_validate_json(line))
+                except ValueError as e:
+                    logger.error(f"[WriteBehindMemory/_load_spilled] Skipping damaged line in {self.spill_path}: {e}")
+        logger.info(f"[WriteBehindMemory/_load_spilled] Found {len(chains)} memory chains waiting to be written")
+        return chains
+
+    def _not_written_memories(self, session: Optional[str] = None) -> List[Memory]:
+        """memories of the session which aren't in the db yet, of all sessions if session is None"""
+        chains = self._spilled + self._in_flight + self.pending
+        return [memory for chain in chains for memory in chain.memories if session is None or memory.session == session]
@@ -1,49 +1,93 @@
+import argparse
 import asyncio
 import os
+from typing import Optional
 from config import SettingsManager, logger
 from core import Weaviate, Async_DB_Interface, Brain, Model, PubSub, WeaviateHelper
+from core.event_manager.async_eda import record_listener_error
+from core.event_manager.transport import SocketTransport, SocketBroker
 from communication import TelegramInterface, BaseInterface, DiscordInterface
+from utils import MetricsServer
+
+# what runs in this process. all - everything in one process, others need pubsub transport set to socket
+ROLES = ('all', 'broker', 'brain', 'interface')
 
 
 class AIAssistant:
-    def __init__(self, settings_manager: SettingsManager, communication: BaseInterface, brain: Brain):
+    def __init__(self, settings_manager: SettingsManager,
+                 communication: Optional[BaseInterface],
+                 brain: Optional[Brain]):
         self.settings_manager = settings_manager
         self.communication = communication
         self.communication_thread = None
         self.brain = brain
 
     async def start(self):
-        await self.brain.start()
-        await self.communication.initialize()
-        self.communication_thread = self.communication.start_in_thread()
+        if self.brain:
+            await self.brain.start()
+        if self.communication:
+            await self.communication.initialize()
+            self.communication_thread = self.communication.start_in_thread()
         await asyncio.sleep(1)
         logger.info(f'[AIAssistant/start] Application is ready to use.')
 
     async def stop(self):
         logger.info(f'[AIAssistant/stop] stopping the Application.')
-        self.brain.close()
-        await self.brain.memory_manager.close()
+        if self.brain:
+            self.brain.close()
+            await self.brain.memory_manager.close()
         logger.info(f'[AIAssistant/stop] Application stopped successfully')
 
 
-async def main():
+async def run_broker(socket_path: str):
+    broker = SocketBroker(socket_path)
+    try:
+        await broker.serve_forever()
+    finally:
+        await broker.stop()
+
+
+async def main(role: str = 'all'):
     token = os.getenv("DISCORD_TOKEN")
     settings_manager = SettingsManager().load_settings()
+    pubsub_settings = settings_manager.config.pubsub
+    if role == 'broker':
+        await run_broker(pubsub_settings.socket_path)
+        return
+    if role != 'all' and pubsub_settings.transport != 'socket':
+        logger.error(f"[main] Role {role} needs pubsub transport set to socket, running everything in this process")
+        role = 'all'
+
     weaviate_base_url = 'http://127.0.0.1:8000'
     weaviate_db = WeaviateHelper(weaviate_base_url)
 
     telegram_settings = settings_manager.config.telegram
-    model = Model(settings_manager.config.llm)
-    pubsub_system = PubSub(pooling_delay=0.1)
-    brain = Brain(
-        memory_manager=weaviate_db,
-        # memory_manager=None,
-        model=model,
-        config=settings_manager.config.brain,
-        pubsub=pubsub_system,
-        publish_to=settings_manager.config.pubsub.processed_message_topic,
-        subscribe_to=settings_manager.config.pubsub.input_message_topic,
-    )
+    transport = SocketTransport(pubsub_settings.socket_path) if pubsub_settings.transport == 'socket' else None
+    pubsub_system = PubSub(pooling_delay=0.1,
+                           error_topic=pubsub_settings.error_topic,
+                           drain_timeout=pubsub_settings.drain_timeout,
+                           transport=transport,
+                           commit_interval=pubsub_settings.commit_interval,
+                           segment_size=pubsub_settings.segment_size_mb * 1024 * 1024,
+                           aging_interval=pubsub_settings.aging_interval,
+                           stats_interval=pubsub_settings.stats_interval)
+    for topic, topic_settings in pubsub_settings.topics.items():
+        pubsub_system.configure_topic(topic, **topic_settings.model_dump())
+    # failures of listeners in every process end up in the logs and metrics of one of them
+    pubsub_system.subscribe(pubsub_settings.error_topic, record_listener_error, group='errors')
+
+    brain = None
+    if role in ('all', 'brain'):
+        model = Model(settings_manager.config.llm)
+        brain = Brain(
+            memory_manager=weaviate_db,
+            # memory_manager=None,
+            model=model,
+            config=settings_manager.config.brain,
+            pubsub=pubsub_system,
+            publish_to=settings_manager.config.pubsub.processed_message_topic,
+            subscribe_to=settings_manager.config.pubsub.input_message_topic,
+        )
 
     # tg_interface = TelegramInterface(
     #     token=token,
@@ -53,14 +97,27 @@ async def main():
     #     subscribe_to=settings_manager.config.pubsub.processed_message_topic,
     #     creator_username=settings_manager.config.brain.creator_name
     # )
-    ds_interface = DiscordInterface(
-        token=token,
-        config=settings_manager.config.discord,
-        pubsub=pubsub_system,
-        publish_to=settings_manager.config.pubsub.input_message_topic,
-        subscribe_to=settings_manager.config.pubsub.processed_message_topic,
-        creator_username=settings_manager.config.brain.creator_name
-    )
+    ds_interface = None
+    if role in ('all', 'interface'):
+        ds_interface = DiscordInterface(
+            token=token,
+            config=settings_manager.config.discord,
+            pubsub=pubsub_system,
+            publish_to=settings_manager.config.pubsub.input_message_topic,
+            subscribe_to=settings_manager.config.pubsub.processed_message_topic,
+            creator_username=settings_manager.config.brain.creator_name
+        )
+
+    metrics_server = None
+    metrics_settings = settings_manager.config.metrics
+    if metrics_settings and metrics_settings.enabled:
+        metrics_server = MetricsServer(metrics_settings.host, metrics_settings.port)
+        try:
+            metrics_server.start()
+        except OSError as e:
+            # with several processes only the first one gets the port
+            logger.warning(f"[main] Couldn't start metrics server on port {metrics_settings.port}: {e}")
+            metrics_server = None
 
     pubsub_system.start()
     ai = AIAssistant(settings_manager, ds_interface, brain)
@@ -73,12 +130,21 @@ async def main():
     except KeyboardInterrupt:
         print("Program interrupted by user.")
     finally:
+        # pubsub first, so that messages already received are answered before brain is closed.
+        # Brain writes queued memories on the pubsub loop before it stops(Brain.astop).
+        # It waits for the drain, in a thread so this loop keeps running meanwhile
+        await asyncio.to_thread(pubsub_system.stop)
         await ai.stop()
-        pubsub_system.stop()
+        if metrics_server:
+            metrics_server.stop()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--role', choices=ROLES, default='all',
+                        help='part of the assistant to run in this process, see docs/configs.md (pubsub.transport)')
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        asyncio.run(main(args.role))
     except KeyboardInterrupt:
         pass
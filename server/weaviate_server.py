@@ -2,6 +2,7 @@ import asyncio
 import os
 import signal
 from contextlib import asynccontextmanager
+from typing import Optional
 
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
@@ -85,7 +86,9 @@ async def delete_memory(request: DeleteMemoryRequest):
             raise HTTPException(status_code=404, detail="Memory with the specified UUID not found")
         logger.info(
             f"[weaviate_server/delete_memory] delete request. Successfully deleted memory object with uuid {request.uuid}")
-        return {"status": "success", "message": f"Memory with UUID {request.uuid} deleted successfully"}
+        return {"status": "success",
+                "message": f"Memory with UUID {request.uuid} deleted successfully",
+                "version": weaviate_db.memory_version}
     except Exception as e:
         logger.error(
             f"[weaviate_server/delete_memory] delete request. got an unexpected error {e}")
@@ -101,16 +104,25 @@ async def add_memories(request: AddMemoriesRequest):
             from_name=memory["from_name"],
             message=memory["message"],
             time=memory["time"],
+            session=memory.get("session"),
         )
-    success = await weaviate_db.add_memories(memory_chain)
-    if not success:
-        logger.waerning(f"[weaviate_server/add_memories] post request. Couldn't add memories successfully.")
+    version = await weaviate_db.add_memories(memory_chain)
+    if version is None:
+        logger.warning(f"[weaviate_server/add_memories] post request. Couldn't add memories successfully.")
         raise HTTPException(status_code=500, detail="Failed to add memories")
 
     logger.info(f"[weaviate_server/add_memories] post request. Successfully added memories.")
-    return {"status": "success", "message": "Memories added successfully"}
+    return {"status": "success", "message": "Memories added successfully", "version": version}
 
 
+@app.get("/memory_version")
+async def memory_version(session: Optional[str] = None):
+    """
+    Version of stored memories of a session(all of them if not given), changes on every add/delete.
+    Cheap for clients to poll instead of refetching chat history, doesn't touch weaviate.
+    """
+    return {"version": weaviate_db.version_of(session)}
+
 
 @app.get("/get_context")
 async def get_context(query: str):
@@ -137,9 +149,9 @@ async def get_context(query: str):
 
 
 @app.get("/get_chat_memory")
-async def get_chat_memory(limit: int = 20):
-    logger.info(f"[weaviate_server/get_chat_memory] get request. Requesting last chat memories with limit of {limit} messages")
-    chat_memory = await weaviate_db.get_chat_memory(limit)
+async def get_chat_memory(limit: int = 20, session: Optional[str] = None):
+    logger.info(f"[weaviate_server/get_chat_memory] get request. Requesting last chat memories of {session} with limit of {limit} messages")
+    chat_memory = await weaviate_db.get_chat_memory(limit, session)
     if not chat_memory:
         logger.info(f"[weaviate_server/get_chat_memory] get request. There were no memories in db")
         return {"chat_history": []}
@@ -150,6 +162,7 @@ async def get_chat_memory(limit: int = 20):
                 "from_name": memory.from_name,
                 "message": memory.message,
                 "time": memory.time,
+                "session": memory.session,
             }
             for memory in chat_memory.memories
         ]
@@ -0,0 +1,88 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+from core.brain.main import Brain
+from core.brain.session import ChatSession, SessionStore
+from core.brain.token_ledger import TokenLedger
+from utils import Message, TextMessage
+
+
+class SlowModel:
+    """Model whose generation never finishes in time"""
+    llm_settings = SimpleNamespace(stream=False, llm_model_name='slow')
+
+    def format_prompt(self, memories):
+        return ' '.join(memory['content'] for memory in memories)
+
+    def count_tokens(self, prompt):
+        return len(prompt.split())
+
+    async def agenerate(self, memories, on_token=None):
+        await asyncio.sleep(10)
+
+
+class StreamingModel(SlowModel):
+    """Streams one token, then hangs. Keeps the callback, so tokens can arrive after the generation was given up"""
+    llm_settings = SimpleNamespace(stream=True, llm_model_name='streaming')
+
+    async def agenerate(self, memories, on_token=None):
+        self.on_token = on_token
+        on_token('first')
+        await asyncio.sleep(10)
+
+
+class FakePubSub:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, message):
+        self.published.append((topic, message))
+
+
+def make_brain(model) -> Brain:
+    # skips __init__, no db, persona file or pubsub subscriptions needed
+    brain = Brain.__new__(Brain)
+    brain.model = model
+    brain.pubsub = FakePubSub()
+    brain.config = SimpleNamespace(fetch_timeout=None, retrieve_timeout=None, generate_timeout=0.05,
+                                   persist_timeout=None, add_context=False, use_memories=True,
+                                   save_memories=False, stream_publish_interval=0.5)
+    brain.token_limit = 2000
+    brain.history_limit = 20
+    brain.receive_topic = 'in'
+    brain.publish_to_topic = 'out'
+    brain.persona = 'You are a test'
+    brain.sessions = SessionStore(factory=lambda key: ChatSession(
+        key=key, memories=[{'role': 'system', 'content': brain.persona}], ledger=TokenLedger(model)))
+    return brain
+
+
+def test_generate_timeout_keeps_history():
+    brain = make_brain(SlowModel())
+    session = brain.sessions.get(('default', 1))
+    session.memories += [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'hello'}]
+    session.history_version = 2  # cached history is valid, nothing is fetched
+    before = list(session.memories)
+
+    message = Message(1, 'user', datetime.datetime.now(), text_content=TextMessage('are you there?'), chat_id=1)
+    asyncio.run(brain._answer(message))
+
+    assert session.memories == before
+    assert session.history_version == 2
+    assert brain.pubsub.published[-1][1].response_message == 'Something went wrong. No response was generated'
+
+
+def test_no_partial_updates_after_timeout():
+    model = StreamingModel()
+    brain = make_brain(model)
+    brain.config.stream_publish_interval = 0  # every token is published
+    brain.sessions.get(('default', 1)).history_version = 0
+
+    message = Message(1, 'user', datetime.datetime.now(), text_content=TextMessage('hi'), chat_id=1)
+    asyncio.run(brain._answer(message))
+    published = len(brain.pubsub.published)
+    model.on_token(' late')  # was already queued on the loop when the generation timed out
+
+    assert len(brain.pubsub.published) == published
+    assert [m.is_partial for _, m in brain.pubsub.published] == [True, False]
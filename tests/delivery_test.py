@@ -0,0 +1,43 @@
+from communication.delivery import split_text, CODE_FENCE
+
+
+def test_short_text_is_not_split():
+    assert split_text('hello', 2000) == ['hello']
+    assert split_text('x' * 5000, 0) == ['x' * 5000]
+
+
+def test_parts_fit_the_limit():
+    text = 'word ' * 1000
+    parts = split_text(text, 2000)
+    assert len(parts) > 1
+    assert all(len(part) <= 2000 for part in parts)
+    assert ' '.join(parts).split() == text.split()
+
+
+def test_splits_at_paragraphs_first():
+    text = 'a' * 1500 + '\n\n' + 'b' * 1500
+    assert split_text(text, 2000) == ['a' * 1500, 'b' * 1500]
+
+
+def test_code_block_is_reopened():
+    text = 'intro\n\n' + CODE_FENCE + 'python\n' + 'x = 1\n' * 1200 + CODE_FENCE + '\nthe end'
+    parts = split_text(text, 2000)
+    assert len(parts) > 3
+    assert all(len(part) <= 2000 for part in parts)
+    # every part is valid markdown on its own
+    assert all(part.count(CODE_FENCE) % 2 == 0 for part in parts)
+    # the block starts in the first part, is cut in every part after it and ends in the last one
+    assert all(part.startswith(CODE_FENCE) for part in parts[1:])
+    assert parts[-1].endswith('the end')
+
+
+def test_no_empty_parts():
+    assert split_text(' ' * 5000 + 'x', 2000) == ['x']
+    assert split_text('x' + ' ' * 5000, 2000) == ['x']
+    assert split_text('\n' * 5000, 2000) == []
+
+
+def test_blank_text_has_no_parts():
+    assert split_text('', 2000) == []
+    assert split_text('   \n', 2000) == []
+    assert split_text('  ', 0) == []
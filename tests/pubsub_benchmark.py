@@ -0,0 +1,167 @@
+"""
+Throughput and latency benchmark of PubSub, runs offline, no bots or models needed.
+
+    python -m tests.pubsub_benchmark                      # full matrix, results in logs/pubsub_benchmark.json
+    python -m tests.pubsub_benchmark --quick              # smaller matrix for a fast check
+    python -m tests.pubsub_benchmark --baseline old.json  # exits with 1 if something got slower than tolerance
+
+Every scenario publishes a burst of messages spread over the topics and measures the time from publish
+until each listener got the message. same_loop publishes from a coroutine on the PubSub loop,
+cross_thread from a separate thread, like the interfaces do.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+from core.event_manager.async_eda import PubSub
+from utils import Message, TextMessage
+
+DEFAULT_OUTPUT = Path(__file__).parent.parent / 'logs' / 'pubsub_benchmark.json'
+
+TOPIC_COUNTS = (1, 4)
+LISTENER_COUNTS = (1, 4)
+PAYLOAD_SIZES = (16, 1024, 64 * 1024)
+MODES = ('same_loop', 'cross_thread')
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[int(fraction * (len(sorted_values) - 1))]
+
+
+def run_scenario(topics: int, listeners: int, payload_size: int, mode: str, messages: int,
+                 timeout: float = 60.0) -> Dict:
+    pubsub = PubSub(drain_timeout=5)
+    topic_names = [f'bench_{i}' for i in range(topics)]
+    expected = messages * listeners
+    latencies: List[float] = []
+    done = threading.Event()
+
+    async def listener(message: Message):
+        latencies.append(time.perf_counter() - message.received_at)
+        if len(latencies) >= expected:
+            done.set()
+
+    for topic in topic_names:
+        for _ in range(listeners):
+            pubsub.subscribe(topic, listener)
+
+    text = TextMessage('x' * payload_size)
+    batch = [Message(id=i, from_user='benchmark', datetime=datetime.now(), text_content=text)
+             for i in range(messages)]
+
+    def publish_all():
+        for message, topic in zip(batch, itertools.cycle(topic_names)):
+            message.received_at = time.perf_counter()
+            pubsub.publish(topic, message)
+
+    async def publish_on_loop():
+        publish_all()
+
+    pubsub.start()
+    time.sleep(0.05)  # let consumers start
+    start = time.perf_counter()
+    if mode == 'same_loop':
+        asyncio.run_coroutine_threadsafe(publish_on_loop(), pubsub.loop).result()
+    else:
+        publisher = threading.Thread(target=publish_all)
+        publisher.start()
+        publisher.join()
+    published = time.perf_counter()
+    finished = done.wait(timeout)
+    delivered = time.perf_counter()
+    pubsub.stop()
+
+    values = sorted(latencies)
+    return {
+        'topics': topics,
+        'listeners': listeners,
+        'payload_size': payload_size,
+        'mode': mode,
+        'messages': messages,
+        'delivered': len(values),
+        'completed': finished,
+        'published_per_sec': round(messages / max(published - start, 1e-9), 1),
+        'delivered_per_sec': round(len(values) / max(delivered - start, 1e-9), 1),
+        'p50_ms': round(percentile(values, 0.50) * 1000, 4) if values else None,
+        'p99_ms': round(percentile(values, 0.99) * 1000, 4) if values else None,
+        'max_ms': round(values[-1] * 1000, 4) if values else None,
+    }
+
+
+def scenario_key(result: Dict) -> tuple:
+    return result['topics'], result['listeners'], result['payload_size'], result['mode']
+
+
+def load_baseline(path: Path) -> Dict[tuple, Dict]:
+    return {scenario_key(result): result for result in json.loads(path.read_text())['results']}
+
+
+def compare(results: List[Dict], baseline: Dict[tuple, Dict], tolerance: float) -> List[str]:
+    """Scenarios with throughput or p99 latency worse than the baseline by more than tolerance(0.2 = 20%)"""
+    regressions = []
+    for result in results:
+        old = baseline.get(scenario_key(result))
+        if not old:
+            continue
+        if result['delivered_per_sec'] < old['delivered_per_sec'] * (1 - tolerance):
+            regressions.append(f"{scenario_key(result)} throughput {old['delivered_per_sec']} -> "
+                               f"{result['delivered_per_sec']} msg/s")
+        if old['p99_ms'] and result['p99_ms'] and result['p99_ms'] > old['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{scenario_key(result)} p99 {old['p99_ms']} -> {result['p99_ms']} ms")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000, help='messages published in every scenario')
+    parser.add_argument('--quick', action='store_true', help='1 and 4 topics, 1 listener, small payload only')
+    parser.add_argument('--output', type=Path, default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', type=Path, help='previous results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    # read before running, baseline can be the previous output file
+    baseline = load_baseline(args.baseline) if args.baseline else None
+
+    matrix = itertools.product(TOPIC_COUNTS, (1,), (16,), MODES) if args.quick else \
+        itertools.product(TOPIC_COUNTS, LISTENER_COUNTS, PAYLOAD_SIZES, MODES)
+
+    run_scenario(1, 1, 16, 'same_loop', args.messages)  # warm up, not recorded
+
+    results = []
+    print(f"{'topics':>6} {'listen':>6} {'payload':>8} {'mode':>12} {'pub/s':>10} {'deliv/s':>10} "
+          f"{'p50 ms':>8} {'p99 ms':>8}")
+    for topics, listeners, payload_size, mode in matrix:
+        result = run_scenario(topics, listeners, payload_size, mode, args.messages)
+        results.append(result)
+        print(f"{topics:>6} {listeners:>6} {payload_size:>8} {mode:>12} {result['published_per_sec']:>10} "
+              f"{result['delivered_per_sec']:>10} {result['p50_ms']:>8} {result['p99_ms']:>8}"
+              f"{'' if result['completed'] else '  INCOMPLETE'}")
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps({
+        'created_at': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results,
+    }, indent=2))
+    print(f"Results saved to {args.output}")
+
+    failed = not all(result['completed'] for result in results)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
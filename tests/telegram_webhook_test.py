@@ -0,0 +1,63 @@
+"""
+Posts recorded telegram updates to the local webhook endpoint, no telegram servers involved.
+Start the assistant with telegram.mode: webhook (webhook_url can stay empty), then
+
+    python -m tests.telegram_webhook_test                          # a sample text message from the creator
+    python -m tests.telegram_webhook_test update1.json update2.json
+    python -m tests.telegram_webhook_test --count 20               # the sample 20 times at once
+
+Update files hold the json telegram sent, e.g. copied from getUpdates or from the logs.
+"""
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import httpx
+
+from config import SettingsManager
+from communication.telegram.webhook import SECRET_HEADER
+
+
+def sample_update(update_id: int, chat_id: int) -> dict:
+    now = int(time.time())
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Tester'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': now,
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Tester'},
+            'from': user,
+            'text': f'Hello from recorded update {update_id}',
+        }
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('updates', nargs='*', type=Path, help='json files with a single update each')
+    parser.add_argument('--count', type=int, default=1, help='how many times the sample update is sent')
+    args = parser.parse_args()
+
+    config = SettingsManager().load_settings().config.telegram
+    url = f'http://{config.webhook_listen}:{config.webhook_port}{config.webhook_path}'
+    headers = {SECRET_HEADER: config.webhook_secret} if config.webhook_secret else {}
+
+    if args.updates:
+        updates = [json.loads(path.read_text()) for path in args.updates]
+    else:
+        updates = [sample_update(int(time.time()) * 100 + i, config.creator_id) for i in range(args.count)]
+
+    async with httpx.AsyncClient() as client:
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(client.post(url, json=update, headers=headers) for update in updates))
+        elapsed = time.perf_counter() - start
+    for update, response in zip(updates, responses):
+        print(f"update {update.get('update_id')}: {response.status_code} {response.text}")
+    print(f"{len(updates)} updates posted in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1 +1,2 @@
-from .help_classes import *
\ No newline at end of file
+from .help_classes import *
+from .metrics import metrics, observe_stage, observe_delivery, StageTimer, MetricsServer, TOKENS_PER_SECOND
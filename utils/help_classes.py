@@ -1,10 +1,16 @@
-from dataclasses import dataclass, field
+import time
+from dataclasses import dataclass, field, replace
 from telegram.ext import CallbackContext
-from typing import Optional
+from typing import Optional, Tuple, Hashable, ClassVar, List
 from datetime import datetime
 from telegram import Update
 from discord.message import Message as Msg
 
+# PubSub serves lower numbers first, messages waiting long enough move up a lane so nothing starves
+PRIORITY_HIGH = 0  # commands, they are quick and the user waits on them
+PRIORITY_NORMAL = 1  # text
+PRIORITY_LOW = 2  # messages with attachments, they take the longest to process
+
 @dataclass
 class TextMessage:
     content: str
@@ -32,6 +38,29 @@ class Message:
 
     # Data back from our model
     response_message: Optional[str] = None
+    # True while response_message holds only the part of the response generated so far
+    is_partial: bool = False
+
+    # time.perf_counter() timestamps for latency metrics
+    received_at: float = field(default_factory=time.perf_counter)
+    responded_at: Optional[float] = None
+
+    priority: int = PRIORITY_NORMAL
+
+    # set by PubSub.request, the reply keeps it so it can be matched with the request
+    correlation_id: Optional[str] = None
+
+    # Fields which can't leave the process(bot objects, sockets). Transport strips them before a message is sent
+    # to another process and puts them back once the reply comes back, local_ref is the key under which they wait.
+    local_fields: ClassVar[Tuple[str, ...]] = ()
+    local_ref: Optional[str] = None
+    # chat id is kept here when local fields are stripped, so that session_key still works in other processes
+    chat_id: Optional[Hashable] = None
+
+    @property
+    def session_key(self) -> Tuple[str, Optional[Hashable]]:
+        """(interface, chat id). Messages with the same key share chat history in the brain"""
+        return 'default', self.chat_id
 
 
 @dataclass
@@ -39,7 +68,36 @@ class TelegramMessage(Message):
     update: Update = field(default=None)
     context: CallbackContext = field(default=None)
 
+    local_fields: ClassVar[Tuple[str, ...]] = ('update', 'context')
+
+    @property
+    def session_key(self) -> Tuple[str, Optional[Hashable]]:
+        return 'telegram', self.update.effective_chat.id if self.update else self.chat_id
+
 
 @dataclass
 class DiscordMessage(Message):
     channel: Msg.channel = field(default=None)
+
+    local_fields: ClassVar[Tuple[str, ...]] = ('channel',)
+
+    @property
+    def session_key(self) -> Tuple[str, Optional[Hashable]]:
+        return 'discord', self.channel.id if self.channel else self.chat_id
+
+
+def can_merge(message: Message) -> bool:
+    # requests wait for a reply to their own message, pictures and voice have to be answered one by one
+    return (message.text_content is not None and message.photo_content is None and message.voice_content is None
+            and message.correlation_id is None)
+
+
+def merge_messages(messages: List[Message]) -> Message:
+    """One message with texts of all the messages, the reply goes to the last of them"""
+    if len(messages) == 1:
+        return messages[0]
+    text = '\n'.join(message.text_content.content for message in messages)
+    return replace(messages[-1],
+                   text_content=TextMessage(text),
+                   received_at=messages[0].received_at,
+                   priority=min(message.priority for message in messages))
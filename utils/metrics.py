@@ -0,0 +1,207 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from config import logger
+
+# seconds, from sub-millisecond queue hops up to long generations
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+    """Prometheus style histogram with an optional single label. Safe to use from any thread."""
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 label: Optional[str] = 'stage'):
+        self.name = name
+        self.documentation = documentation
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        self.label = label
+        # label value -> (counts per bucket + +Inf, sum)
+        self._series: Dict[str, Tuple[List[int], float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, label_value: str = '') -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.get(label_value, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._series[label_value] = (counts, total + value)
+
+    def snapshot(self) -> Dict[str, dict]:
+        """label value -> count, sum and cumulative bucket counts"""
+        with self._lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+
+        result = {}
+        for label_value, (counts, total) in series.items():
+            cumulative, running = [], 0
+            for count in counts:
+                running += count
+                cumulative.append(running)
+            result[label_value] = {'count': running, 'sum': total, 'buckets': cumulative}
+        return result
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_value, data in sorted(self.snapshot().items()):
+            labels = f'{self.label}="{label_value}",' if self.label else ''
+            for bound, count in zip(self.buckets + (float('inf'),), data['buckets']):
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{{labels}le="{le}"}} {count}')
+            suffix = f'{{{labels[:-1]}}}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {data["sum"]}')
+            lines.append(f'{self.name}_count{suffix} {data["count"]}')
+        return '\n'.join(lines)
+
+
+class Gauge:
+    """Value which goes up and down, with an optional single label. Safe to use from any thread."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, label: Optional[str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, label_value: str = '') -> None:
+        with self._lock:
+            self._values[label_value] = value
+
+    def remove(self, label_value: str = '') -> None:
+        with self._lock:
+            self._values.pop(label_value, None)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for label_value, value in sorted(self.snapshot().items()):
+            labels = f'{{{self.label}="{label_value}"}}' if self.label else ''
+            lines.append(f'{self.name}{labels} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Gauge):
+    """Value which only goes up"""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, label_value: str = '') -> None:
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Union[Histogram, Gauge]] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS,
+                  label: Optional[str] = 'stage') -> Histogram:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, documentation, buckets, label)
+            return self._metrics[name]
+
+    def gauge(self, name: str, documentation: str, label: Optional[str] = None) -> Gauge:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Gauge(name, documentation, label)
+            return self._metrics[name]
+
+    def counter(self, name: str, documentation: str, label: Optional[str] = None) -> Counter:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Counter(name, documentation, label)
+            return self._metrics[name]
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram(
+    'raise_stage_seconds',
+    'Time spent in each stage of the message lifecycle.')
+TOKENS_PER_SECOND = metrics.histogram(
+    'raise_generation_tokens_per_second',
+    'Speed of token generation, prompt evaluation excluded.',
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 200),
+    label=None)
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage)
+
+
+def observe_delivery(message: 'Message') -> None:
+    """Called by interfaces once the final response was sent to the user."""
+    if message.is_partial or message.responded_at is None:
+        return
+    now = time.perf_counter()
+    observe_stage('delivery', now - message.responded_at)
+    observe_stage('total', now - message.received_at)
+
+
+class StageTimer:
+    """with StageTimer('build'): ... records how long the block took"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.start: float = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        observe_stage(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"[MetricsServer] {self.address_string()} {format % args}")
+
+
+class MetricsServer:
+    """Serves metrics in prometheus text format on http://host:port/metrics from a daemon thread."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9100):
+        self.host = host
+        self.port = port
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._server = ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"[MetricsServer/start] Serving metrics at http://{self.host}:{self.port}/metrics")
+
+    def stop(self) -> None:
+        if not self._server:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        logger.info(f"[MetricsServer/stop] Metrics server stopped")